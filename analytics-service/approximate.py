@@ -0,0 +1,261 @@
+"""
+Stratified event sample for approximate stats (`?approx=`).
+
+Every stored event draws u uniformly from [0, 1). For each UTC day (the
+stratum), event_sample keeps the events whose u is below the day's threshold.
+A maintenance thread lowers the threshold to the SAMPLE_STRATUM_SIZE-th
+smallest u of the day and deletes the rows above it, so a day holds about
+SAMPLE_STRATUM_SIZE events (a bottom-k sample). The events of a day with u
+below any t <= threshold are then a Bernoulli(t) sample of that day.
+
+An estimate with target relative error e needs about n = (1.96 / e)^2
+sampled events, whatever the range. It reads the events with u < t, where
+t = n / (estimated events in the range), capped per day at the day's
+threshold, and scales them up by 1/t (Horvitz-Thompson). The rows read are
+bounded by n plus SAMPLE_STRATUM_SIZE for each day already sampled below t,
+not by the size of view_event. The variance estimate
+sum((1 - t) / t^2 * w^2) gives a 95% confidence interval.
+"""
+import logging
+import math
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.exc import IntegrityError
+
+import partitions
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_STRATUM_SIZE = int(os.getenv('SAMPLE_STRATUM_SIZE', '20000'))
+SAMPLE_MAINTENANCE_INTERVAL = int(os.getenv('SAMPLE_MAINTENANCE_INTERVAL', '60'))
+SAMPLE_THRESHOLD_REFRESH = int(os.getenv('SAMPLE_THRESHOLD_REFRESH', '30'))
+SAMPLE_TRIM_BATCH_SIZE = 5000
+# Days still receiving events, whose strata maintenance trims
+SAMPLE_ACTIVE_DAYS = 2
+
+CONFIDENCE = 0.95
+Z_95 = 1.96
+MAX_TARGET_ERROR = 0.5
+
+
+def draw():
+    return random.random()
+
+
+def parse_target_error(value):
+    """Parse `?approx=`: a relative error in (0, MAX_TARGET_ERROR]; raise ValueError otherwise."""
+    try:
+        target = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid approx '{value}'; use a relative error such as 0.01")
+    if not 0 < target <= MAX_TARGET_ERROR:
+        raise ValueError(f"approx must be greater than 0 and at most {MAX_TARGET_ERROR}")
+    return target
+
+
+class Thresholds:
+    """Per-process cache of the stratum thresholds that decide which events ingest samples."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.loaded_at = 0.0
+
+    def get(self, engine, day):
+        now = time.monotonic()
+        if now - self.loaded_at >= SAMPLE_THRESHOLD_REFRESH:
+            with self.lock:
+                if now - self.loaded_at >= SAMPLE_THRESHOLD_REFRESH:
+                    self.loaded_at = now
+                    try:
+                        with engine.connect() as conn:
+                            rows = conn.execute(text(
+                                "SELECT day, threshold FROM sample_stratum WHERE day >= :since"
+                            ), {'since': datetime.utcnow().date() - timedelta(days=SAMPLE_ACTIVE_DAYS)}).fetchall()
+                        self.values = {str(day): threshold for day, threshold in rows}
+                    except Exception as e:
+                        # A stale (higher) threshold only keeps extra rows until the next trim
+                        logger.warning(f"Failed to load sample thresholds: {str(e)}")
+        # Days not trimmed yet keep every event
+        return self.values.get(str(day), 1.0)
+
+
+def _save_stratum(conn, day, threshold, rows, table='sample_stratum'):
+    params = {'day': day, 'threshold': threshold, 'rows': rows, 'now': datetime.utcnow()}
+    updated = conn.execute(text(
+        f"UPDATE {table} SET threshold = :threshold, sampled_rows = :rows, updated_at = :now "
+        "WHERE day = :day"
+    ), params).rowcount
+    if not updated:
+        conn.execute(text(
+            f"INSERT INTO {table} (day, threshold, sampled_rows, updated_at) "
+            "VALUES (:day, :threshold, :rows, :now)"
+        ), params)
+
+
+def trim_stratum(engine, day):
+    """Cut a day's sample down to its SAMPLE_STRATUM_SIZE - 1 smallest u and record the threshold."""
+    with engine.connect() as conn:
+        rows = conn.execute(text("SELECT COUNT(*) FROM event_sample WHERE day = :day"), {'day': day}).scalar()
+        stored = conn.execute(text("SELECT threshold FROM sample_stratum WHERE day = :day"), {'day': day}).scalar()
+        threshold = 1.0 if stored is None else stored
+        if rows >= SAMPLE_STRATUM_SIZE:
+            threshold = min(threshold, conn.execute(text(
+                "SELECT u FROM event_sample WHERE day = :day ORDER BY u LIMIT 1 OFFSET :offset"
+            ), {'day': day, 'offset': SAMPLE_STRATUM_SIZE - 1}).scalar())
+
+    # Rows at or above the threshold go in short batches, like the deletion worker's
+    while True:
+        with engine.begin() as conn:
+            ids = [row[0] for row in conn.execute(text(
+                "SELECT id FROM event_sample WHERE day = :day AND u >= :threshold LIMIT :limit"
+            ), {'day': day, 'threshold': threshold, 'limit': SAMPLE_TRIM_BATCH_SIZE})]
+            if ids:
+                conn.execute(text("DELETE FROM event_sample WHERE id IN :ids")
+                             .bindparams(bindparam('ids', expanding=True)), {'ids': ids})
+        if len(ids) < SAMPLE_TRIM_BATCH_SIZE:
+            break
+
+    with engine.begin() as conn:
+        rows = conn.execute(text("SELECT COUNT(*) FROM event_sample WHERE day = :day"), {'day': day}).scalar()
+        try:
+            _save_stratum(conn, day, threshold, rows)
+        except IntegrityError:
+            pass  # another worker recorded the stratum first
+    return threshold, rows
+
+
+def maintain_sample(engine, today=None):
+    """Trim the strata of the active days and drop strata past EVENT_RETENTION_DAYS."""
+    today = today or datetime.utcnow().date()
+    for offset in range(SAMPLE_ACTIVE_DAYS):
+        trim_stratum(engine, today - timedelta(days=offset))
+    if partitions.EVENT_RETENTION_DAYS > 0:
+        cutoff = today - timedelta(days=partitions.EVENT_RETENTION_DAYS)
+        with engine.begin() as conn:
+            conn.execute(text("DELETE FROM event_sample WHERE day < :cutoff"), {'cutoff': cutoff})
+            conn.execute(text("DELETE FROM sample_stratum WHERE day < :cutoff"), {'cutoff': cutoff})
+
+
+def _random(conn):
+    """SQL expression for a uniform draw in [0, 1)."""
+    if conn.dialect.name == 'mysql':
+        return "RAND()"
+    return "((RANDOM() & 1073741823) / 1073741824.0)"
+
+
+def sample_day(conn, day, events, sample_table='event_sample', stratum_table='sample_stratum'):
+    """
+    Sample the `events` view_event rows of one day, keeping about
+    SAMPLE_STRATUM_SIZE. The day is sampled at rate r = SAMPLE_STRATUM_SIZE /
+    events, and the kept events get u uniform in [0, r). Returns the number
+    of rows sampled.
+    """
+    start = datetime.combine(day, datetime.min.time())
+    rate = min(1.0, SAMPLE_STRATUM_SIZE / events) if events else 1.0
+    draw_sql = _random(conn)
+    rows = conn.execute(text(
+        f"INSERT INTO {sample_table} (day, u, paste_id, device, browser, sample_weight) "
+        f"SELECT :day, {draw_sql} * :rate, paste_id, device, browser, sample_weight FROM view_event "
+        f"WHERE timestamp >= :start AND timestamp < :end AND {draw_sql} < :rate"
+    ), {'day': day, 'rate': rate, 'start': start, 'end': start + timedelta(days=1)}).rowcount
+    _save_stratum(conn, day, rate, rows, table=stratum_table)
+    return rows
+
+
+def events_per_day(conn, start=None, end=None):
+    """(day, events) of view_event, optionally for timestamps in [start, end)."""
+    filters, params = [], {}
+    if start is not None:
+        filters.append("timestamp >= :start")
+        params['start'] = start
+    if end is not None:
+        filters.append("timestamp < :end")
+        params['end'] = end
+    where = f" WHERE {' AND '.join(filters)}" if filters else ""
+    rows = conn.execute(text(
+        f"SELECT DATE(timestamp), COUNT(*) FROM view_event{where} GROUP BY DATE(timestamp)"
+    ), params).fetchall()
+    return [(datetime.strptime(str(day), '%Y-%m-%d').date(), events) for day, events in rows]
+
+
+def backfill(conn):
+    """Sample the view_event rows of every day without a stratum (see sample_day())."""
+    sampled = {str(day) for (day,) in conn.execute(text("SELECT day FROM sample_stratum"))}
+    for day, events in events_per_day(conn):
+        if str(day) not in sampled:
+            sample_day(conn, day, events)
+
+
+def start_maintenance(engine):
+    """Run maintain_sample() now and then every SAMPLE_MAINTENANCE_INTERVAL seconds."""
+    def run():
+        while True:
+            try:
+                maintain_sample(engine)
+            except Exception as e:
+                logger.error(f"Sample maintenance failed: {str(e)}")
+            time.sleep(SAMPLE_MAINTENANCE_INTERVAL)
+
+    thread = threading.Thread(target=run, name='sample-maintenance', daemon=True)
+    thread.start()
+    return thread
+
+
+def estimate(engine, target_error, start_day=None, end_day=None, group_by=None):
+    """
+    Estimate the weighted number of events between start_day and end_day
+    (inclusive; open-ended when None), in total or per value of the
+    event_sample column `group_by`. Returns {group: (estimate, ci_low,
+    ci_high)} (the only group is None without group_by) and the number of
+    sampled rows read.
+    """
+    params = {'start_day': start_day, 'end_day': end_day}
+
+    def day_range(column):
+        filters = []
+        if start_day is not None:
+            filters.append(f" AND {column} >= :start_day")
+        if end_day is not None:
+            filters.append(f" AND {column} <= :end_day")
+        return "".join(filters)
+
+    with engine.connect() as conn:
+        strata = conn.execute(text(
+            f"SELECT day, threshold, sampled_rows FROM sample_stratum WHERE 1 = 1{day_range('day')}"
+        ), params).fetchall()
+        population = sum(rows / threshold for _, threshold, rows in strata if threshold > 0)
+        needed = (Z_95 / target_error) ** 2
+        rate = min(1.0, needed / population) if population else 1.0
+
+        group_column = f"s.{group_by}, " if group_by else ""
+        rows = conn.execute(text(
+            f"SELECT {group_column}s.day, COALESCE(st.threshold, 1.0), SUM(s.sample_weight), "
+            "SUM(s.sample_weight * s.sample_weight), COUNT(*) "
+            "FROM event_sample s LEFT JOIN sample_stratum st ON st.day = s.day "
+            f"WHERE s.u < :rate AND s.u < COALESCE(st.threshold, 1.0){day_range('s.day')} "
+            f"GROUP BY {group_column}s.day, st.threshold"
+        ), dict(params, rate=rate)).fetchall()
+
+    totals = {}
+    sampled = 0
+    for row in rows:
+        group = row[0] if group_by else None
+        threshold, weights, squares, count = row[-4:]
+        t = min(rate, threshold)
+        total, variance = totals.get(group, (0.0, 0.0))
+        totals[group] = (total + weights / t, variance + (1 - t) / (t * t) * squares)
+        sampled += count
+
+    result = {}
+    for group, (total, variance) in totals.items():
+        margin = Z_95 * math.sqrt(variance)
+        result[group] = (total, max(0.0, total - margin), total + margin)
+    if not group_by and None not in result:
+        result[None] = (0.0, 0.0, 0.0)
+    return result, sampled
@@ -0,0 +1,193 @@
+"""
+Background deletion of a paste's analytics data.
+
+Deleting every event of a popular paste in one statement holds row locks and
+undo for the whole delete and stalls ingestion. Instead, a delete request only
+records a job in the deletion_job table. A worker thread then removes the
+events in batches of DELETION_BATCH_SIZE rows. Each batch is its own short
+transaction, and the worker sleeps DELETION_BATCH_PAUSE seconds between
+batches.
+
+Progress is committed with every batch, so the table itself is the checkpoint.
+A job that is left 'running' by a process that died is picked up again once
+its heartbeat is older than DELETION_STALE_SECONDS.
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, text
+
+logger = logging.getLogger(__name__)
+
+DELETION_BATCH_SIZE = int(os.getenv('DELETION_BATCH_SIZE', '1000'))
+DELETION_BATCH_PAUSE = float(os.getenv('DELETION_BATCH_PAUSE', '0.1'))
+DELETION_POLL_INTERVAL = float(os.getenv('DELETION_POLL_INTERVAL', '2'))
+DELETION_STALE_SECONDS = int(os.getenv('DELETION_STALE_SECONDS', '60'))
+
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+ACTIVE = (PENDING, RUNNING)
+
+WORKER_ID = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+def queue_jobs(engine, paste_ids, chunk_size=500):
+    """
+    Queue a deletion job for each paste with analytics data, reusing a job
+    already active for the paste. Pastes are checked and queued in chunks of
+    `chunk_size`, one short transaction each. Returns {paste_id: job_id} and
+    the pastes without any data.
+    """
+    jobs, not_found = {}, []
+    for start in range(0, len(paste_ids), chunk_size):
+        chunk = paste_ids[start:start + chunk_size]
+        params = {'ids': chunk, 'pending': PENDING, 'running': RUNNING}
+        with engine.begin() as conn:
+            active = dict(conn.execute(text(
+                "SELECT paste_id, MIN(id) FROM deletion_job "
+                "WHERE paste_id IN :ids AND status IN (:pending, :running) GROUP BY paste_id"
+            ).bindparams(bindparam('ids', expanding=True)), params).fetchall())
+            known = {row[0] for row in conn.execute(text(
+                "SELECT paste_id FROM paste_metadata WHERE paste_id IN :ids"
+            ).bindparams(bindparam('ids', expanding=True)), params)}
+            known.update(row[0] for row in conn.execute(text(
+                "SELECT DISTINCT paste_id FROM view_event WHERE paste_id IN :ids"
+            ).bindparams(bindparam('ids', expanding=True)), params))
+            new = [paste_id for paste_id in chunk if paste_id in known and paste_id not in active]
+            if new:
+                now = datetime.utcnow()
+                conn.execute(text(
+                    "INSERT INTO deletion_job (paste_id, status, deleted_rows, batches, created_at, updated_at) "
+                    "VALUES (:paste_id, :pending, 0, 0, :now, :now)"
+                ), [{'paste_id': paste_id, 'pending': PENDING, 'now': now} for paste_id in new])
+                active.update(conn.execute(text(
+                    "SELECT paste_id, MAX(id) FROM deletion_job "
+                    "WHERE paste_id IN :ids AND status = :pending GROUP BY paste_id"
+                ).bindparams(bindparam('ids', expanding=True)), {'ids': new, 'pending': PENDING}).fetchall())
+        for paste_id in chunk:
+            if paste_id in active:
+                jobs[paste_id] = active[paste_id]
+            else:
+                not_found.append(paste_id)
+    return jobs, not_found
+
+
+def _claim(conn, job_id):
+    """Take ownership of a pending job or of a running job whose owner went quiet."""
+    now = datetime.utcnow()
+    result = conn.execute(text(
+        "UPDATE deletion_job SET status = :running, owner = :owner, updated_at = :now, "
+        "started_at = COALESCE(started_at, :now) "
+        "WHERE id = :id AND (status = :pending OR (status = :running AND updated_at < :stale))"
+    ), {'running': RUNNING, 'pending': PENDING, 'owner': WORKER_ID, 'now': now, 'id': job_id,
+        'stale': now - timedelta(seconds=DELETION_STALE_SECONDS)})
+    return result.rowcount == 1
+
+
+def _next_job(engine):
+    with engine.begin() as conn:
+        candidates = conn.execute(text(
+            "SELECT id FROM deletion_job WHERE status = :pending "
+            "OR (status = :running AND updated_at < :stale) ORDER BY id LIMIT 10"
+        ), {'pending': PENDING, 'running': RUNNING,
+            'stale': datetime.utcnow() - timedelta(seconds=DELETION_STALE_SECONDS)}).fetchall()
+        for (job_id,) in candidates:
+            if _claim(conn, job_id):
+                return conn.execute(text("SELECT id, paste_id FROM deletion_job WHERE id = :id"),
+                                    {'id': job_id}).fetchone()
+    return None
+
+
+def _delete_batch(engine, job_id, paste_id):
+    """Delete up to DELETION_BATCH_SIZE events and record the progress; return the row count."""
+    with engine.begin() as conn:
+        # Oldest events first, read in order from ix_view_event_paste_timestamp, so a
+        # batch spans a narrow time range and its DELETE is pruned to the
+        # partitions of that range (the primary key is (id, timestamp))
+        rows = conn.execute(text(
+            "SELECT id, timestamp FROM view_event WHERE paste_id = :paste_id ORDER BY timestamp LIMIT :limit"
+        ), {'paste_id': paste_id, 'limit': DELETION_BATCH_SIZE}).fetchall()
+        ids = [row[0] for row in rows]
+        if ids:
+            conn.execute(text(
+                "DELETE FROM view_event WHERE timestamp >= :first AND timestamp <= :last AND id IN :ids"
+            ).bindparams(bindparam('ids', expanding=True)),
+                {'first': rows[0][1], 'last': rows[-1][1], 'ids': ids})
+        result = conn.execute(text(
+            "UPDATE deletion_job SET deleted_rows = deleted_rows + :deleted, batches = batches + 1, "
+            "updated_at = :now WHERE id = :id AND owner = :owner"
+        ), {'deleted': len(ids), 'now': datetime.utcnow(), 'id': job_id, 'owner': WORKER_ID})
+        if result.rowcount != 1:
+            # Another worker reclaimed the job; let it carry on
+            raise RuntimeError(f"Lost ownership of deletion job {job_id}")
+    return len(ids)
+
+
+def _finish(engine, job_id, paste_id):
+    """Delete the paste's remaining rows; returns its (first_seen, last_seen), or None if it had no metadata."""
+    with engine.begin() as conn:
+        seen = conn.execute(text(
+            "SELECT first_seen, last_seen FROM paste_metadata WHERE paste_id = :paste_id"
+        ), {'paste_id': paste_id}).fetchone()
+        conn.execute(text("DELETE FROM paste_metadata WHERE paste_id = :paste_id"), {'paste_id': paste_id})
+        conn.execute(text("DELETE FROM referrer_daily WHERE paste_id = :paste_id"), {'paste_id': paste_id})
+        conn.execute(text("DELETE FROM event_sample WHERE paste_id = :paste_id"), {'paste_id': paste_id})
+        now = datetime.utcnow()
+        conn.execute(text(
+            "UPDATE deletion_job SET status = :done, updated_at = :now, finished_at = :now WHERE id = :id"
+        ), {'done': DONE, 'now': now, 'id': job_id})
+    if not seen:
+        return None
+    # SQLite hands DATETIME columns back as strings
+    return tuple(datetime.fromisoformat(value) if isinstance(value, str) else value for value in seen)
+
+
+def run_job(engine, job_id, paste_id, on_done=None):
+    logger.info(f"Deleting analytics data for paste {paste_id} (job {job_id})")
+    try:
+        while _delete_batch(engine, job_id, paste_id):
+            time.sleep(DELETION_BATCH_PAUSE)
+        seen = _finish(engine, job_id, paste_id)
+    except Exception as e:
+        logger.error(f"Deletion job {job_id} for paste {paste_id} failed: {str(e)}")
+        with engine.begin() as conn:
+            conn.execute(text(
+                "UPDATE deletion_job SET status = :failed, error = :error, updated_at = :now "
+                "WHERE id = :id AND owner = :owner"
+            ), {'failed': FAILED, 'error': str(e)[:1000], 'now': datetime.utcnow(),
+                'id': job_id, 'owner': WORKER_ID})
+        return False
+
+    logger.info(f"Finished deletion job {job_id} for paste {paste_id}")
+    if on_done:
+        try:
+            on_done(paste_id, *(seen or (None, None)))
+        except Exception as e:
+            logger.warning(f"Post-deletion cleanup for paste {paste_id} failed: {str(e)}")
+    return True
+
+
+def start_worker(engine, on_done=None):
+    """
+    Process deletion jobs on a daemon thread, polling every DELETION_POLL_INTERVAL
+    seconds. on_done(paste_id, first_seen, last_seen) runs after each job, with
+    the deleted paste_metadata bounds (None when the paste had none).
+    """
+    def run():
+        while True:
+            try:
+                job = _next_job(engine)
+            except Exception as e:
+                logger.error(f"Failed to fetch deletion jobs: {str(e)}")
+                job = None
+            if job:
+                run_job(engine, job.id, job.paste_id, on_done)
+            else:
+                time.sleep(DELETION_POLL_INTERVAL)
+
+    thread = threading.Thread(target=run, name='deletion-worker', daemon=True)
+    thread.start()
+    return thread
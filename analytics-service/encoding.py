@@ -0,0 +1,78 @@
+"""
+Compact encodings for view_event columns.
+
+IP addresses are stored as packed VARBINARY(16) (4 bytes for IPv4, 16 for
+IPv6, the same layout as MySQL's INET6_ATON), user and session ids as
+BINARY(16) UUID bytes, and user agent / referrer strings as integer ids into
+dictionary tables. These helpers convert between the stored and the readable
+forms, and normalize referrers to the domain they are grouped by.
+"""
+import hashlib
+import ipaddress
+import uuid
+from urllib.parse import urlsplit
+
+MAX_STRING_LENGTH = 255
+
+
+def encode_ip(value):
+    """Pack an IPv4/IPv6 address string; unparseable values are dropped."""
+    if not value:
+        return None
+    try:
+        return ipaddress.ip_address(value).packed
+    except ValueError:
+        return None
+
+
+def decode_ip(value):
+    if not value:
+        return None
+    return str(ipaddress.ip_address(bytes(value)))
+
+
+def encode_uuid(value):
+    """
+    Return the 16 bytes of a UUID string. Ids that are not UUIDs are stored as
+    their MD5 digest, which keeps them distinct but not recoverable.
+    """
+    if not value:
+        return None
+    try:
+        return uuid.UUID(str(value)).bytes
+    except ValueError:
+        return hashlib.md5(str(value).encode('utf-8')).digest()
+
+
+def decode_uuid(value):
+    if not value:
+        return None
+    return str(uuid.UUID(bytes=bytes(value)))
+
+
+def clip(value, length=MAX_STRING_LENGTH):
+    """Normalize a dictionary string: empty becomes None, long values are truncated."""
+    if not value:
+        return None
+    return str(value)[:length]
+
+
+def referrer_domain(value):
+    """
+    Normalize a referrer URL to its lowercased host without port or a leading
+    "www.", e.g. "https://www.Google.com:443/search?q=x" -> "google.com".
+    Values without a recognizable host become None.
+    """
+    if not value:
+        return None
+    value = str(value).strip()
+    try:
+        host = urlsplit(value if '//' in value else f"//{value}").hostname
+    except ValueError:
+        return None
+    if not host or any(c.isspace() for c in host):
+        return None
+    host = host.rstrip('.')
+    if host.startswith('www.'):
+        host = host[4:]
+    return clip(host)
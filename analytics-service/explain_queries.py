@@ -0,0 +1,257 @@
+"""
+Query-plan check for the analytics stats endpoints.
+
+Calls each stats endpoint (bypassing the result cache) against the configured
+database and records the SELECTs it issues. Each distinct statement is then
+run through EXPLAIN (EXPLAIN QUERY PLAN on SQLite). The script exits non-zero
+if any of them does a full scan of a table with at least --min-rows rows, e.g.
+because a covering index was dropped or a filter stopped being sargable, or if
+an endpoint fails, so it can gate CI.
+
+    python explain_queries.py                  # check against the current data
+    python explain_queries.py --seed 200000    # insert synthetic events first
+
+Plans depend on table statistics, so run it against a database of realistic
+size. --seed writes synthetic rows into DATABASE_URL: never point it at
+production.
+"""
+import argparse
+import random
+import re
+import sys
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, text
+
+from app import (app, db, dictionary_id, recent_events, stats_cache,
+                 PasteMetadata, Referrer, ReferrerDomain, UserAgent, ViewEvent)
+import approximate
+import columnar
+import encoding
+import export
+import migrations
+import user_agents
+
+# Tables the stats endpoints read that must never be scanned in full
+CHECKED_TABLES = ('view_event', 'referrer_daily', 'paste_metadata', 'processing_error', 'event_sample')
+
+ENDPOINTS = (
+    ('index', '/'),
+    ('dashboard', '/dashboard'),
+    ('paste_analytics', '/paste/{paste_id}'),
+    ('api_stats_dashboard', '/api/stats/dashboard'),
+    ('api_stats_summary', '/api/stats/summary'),
+    ('api_stats_summary', '/api/stats/summary?approx=0.05'),
+    ('api_stats_dashboard', '/api/stats/dashboard?approx=0.05'),
+    ('api_stats_top_pastes', '/api/stats/top_pastes?limit=10'),
+    ('api_stats_top_pastes', '/api/stats/top_pastes?limit=10&exact=true'),
+    ('api_stats_trending', '/api/stats/trending?window=trending&exact=true'),
+    ('api_stats_trending', '/api/stats/trending?window=6h&exact=true'),
+    ('api_stats_trending', '/api/stats/trending?window=7d'),
+    ('api_stats_paste', '/api/stats/paste/{paste_id}'),
+    ('api_stats_time_series', '/api/stats/time_series?interval=day&days=7'),
+    ('api_stats_time_series', '/api/stats/time_series?interval=hour&days=1&paste_id={paste_id}'),
+    ('api_stats_referrers', '/api/stats/referrers?days=30'),
+    ('api_stats_referrers', '/api/stats/referrers?days=30&paste_id={paste_id}'),
+    ('api_stats_sessions', '/api/stats/sessions?days=7'),
+    ('api_stats_sessions', '/api/stats/sessions?days=7&paste_id={paste_id}'),
+    ('api_stats_user_agents', '/api/stats/user-agents?days=30'),
+    ('api_stats_user_agents', '/api/stats/user-agents?days=30&paste_id={paste_id}'),
+    ('get_expired_pastes', '/api/pastes/expired'),
+    ('get_expired_pastes', '/api/pastes/expired?after=2000-01-01T00:00:00,0&limit=100&partition=3&partitions=8'),
+    ('get_paste_digest', '/api/pastes/digest?buckets=16'),
+    ('get_paste_ids', '/api/pastes/ids?start=0&end=200'),
+    ('export_events', '/api/export/events?days=7&limit=20000'),
+    ('export_events', '/api/export/events?days=7&paste_id={paste_id}'),
+    ('export_events', '/api/export/events?days=7&format=csv&limit=1000'),
+    ('api_query', '/api/query?minutes=60&group_by=paste_id&metric=count'),
+    ('api_query', '/api/query?paste_id={paste_id}&group_by=minute&metric=distinct:session'),
+)
+
+SEED_BATCH_SIZE = 5000
+SEED_USER_AGENTS = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/120.0 Safari/537.36',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (X11; Linux x86_64; rv:121.0) Gecko/20100101 Firefox/121.0',
+    'Googlebot/2.1 (+http://www.google.com/bot.html)',
+)
+SEED_REFERRERS = (None, 'https://www.google.com/search?q=paste', 'https://t.co/abc', 'https://news.ycombinator.com/')
+
+
+def seed(count, pastes=500, days=60):
+    """Insert `count` synthetic view events spread over the last `days` days."""
+    agents = [(dictionary_id(UserAgent, ua), user_agents.classify(ua)) for ua in SEED_USER_AGENTS]
+    referrers = [(dictionary_id(Referrer, ref), dictionary_id(ReferrerDomain, encoding.referrer_domain(ref)))
+                 for ref in SEED_REFERRERS]
+    sessions = [uuid.uuid4().bytes for _ in range(max(1, count // 5))]
+    now = datetime.utcnow()
+    table = ViewEvent.__table__
+
+    for start in range(0, count, SEED_BATCH_SIZE):
+        rows = []
+        for _ in range(min(SEED_BATCH_SIZE, count - start)):
+            agent_id, (browser, device) = random.choice(agents)
+            referrer_id, domain_id = random.choice(referrers)
+            paste_id = int(random.paretovariate(1.2)) % pastes + 1
+            rows.append({
+                'paste_id': paste_id,
+                'short_url': f"seed{paste_id}",
+                'view_count': 1,
+                'ip_bin': random.getrandbits(32).to_bytes(4, 'big'),
+                'session_bin': random.choice(sessions),
+                'referrer_id': referrer_id,
+                'referrer_domain_id': domain_id,
+                'user_agent_id': agent_id,
+                'browser': browser,
+                'device': device,
+                'timestamp': now - timedelta(seconds=random.randint(0, days * 86400)),
+                'sample_weight': 1.0,
+            })
+        with db.engine.begin() as conn:
+            conn.execute(table.insert(), rows)
+        print(f"Seeded {start + len(rows)}/{count} events")
+
+    with db.engine.begin() as conn:
+        conn.execute(text("DELETE FROM referrer_daily"))
+        conn.execute(text(
+            "INSERT INTO referrer_daily (paste_id, day, referrer_domain_id, views) "
+            "SELECT paste_id, DATE(timestamp), COALESCE(referrer_domain_id, 0), SUM(sample_weight) "
+            "FROM view_event GROUP BY paste_id, DATE(timestamp), COALESCE(referrer_domain_id, 0)"
+        ))
+        conn.execute(text(
+            "INSERT INTO paste_metadata (paste_id, short_url, first_seen, last_seen) "
+            "SELECT paste_id, MAX(short_url), MIN(timestamp), MAX(timestamp) FROM view_event "
+            "WHERE paste_id NOT IN (SELECT paste_id FROM paste_metadata) GROUP BY paste_id"
+        ))
+        conn.execute(text("DELETE FROM event_sample"))
+        conn.execute(text("DELETE FROM sample_stratum"))
+        approximate.backfill(conn)
+
+
+def capture_statements(paste_id):
+    """
+    Run every endpoint once and return [(endpoint path, statement,
+    parameters)] and the paths of the endpoints that failed.
+    """
+    captured = []
+    errors = []
+    current = {}
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith('SELECT'):
+            captured.append((current['path'], statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        # /api/query answers from the recent events buffer; check the query that fills it
+        current['path'] = 'recent events buffer'
+        columnar.COLUMNAR_ENABLED = True
+        recent_events.refresh(db.engine, ViewEvent.__table__)
+        stats_cache.enabled = False  # cached responses would skip their queries
+        for endpoint, path in ENDPOINTS:
+            path = path.format(paste_id=paste_id)
+            current['path'] = path
+            view = app.view_functions[endpoint]
+            with app.test_request_context(path):
+                kwargs = app.url_map.bind('localhost').match(path.split('?')[0])[1]
+                try:
+                    response = app.make_response(view(**kwargs))
+                    body = response.get_data(as_text=True)  # also runs the queries of streamed responses
+                    if response.status_code != 200:
+                        print(f"ERROR {path}: HTTP {response.status_code} {body[:200]}")
+                        errors.append(path)
+                    elif endpoint == 'export_events' and export.ends_with_error(
+                            body, 'csv' if 'format=csv' in path else 'ndjson'):
+                        print(f"ERROR {path}: export ended with an error record")
+                        errors.append(path)
+                except Exception as e:
+                    print(f"ERROR {path}: {str(e)}")
+                    errors.append(path)
+                finally:
+                    db.session.remove()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    return captured, errors
+
+
+def full_scans(conn, statement, parameters):
+    """Return (plan lines, names of tables the plan reads in full)."""
+    if conn.dialect.name == 'mysql':
+        rows = conn.exec_driver_sql(f"EXPLAIN {statement}", parameters).mappings().all()
+        lines = [f"{row['table']}: type={row['type']} key={row['key']} extra={row['Extra']}" for row in rows]
+        scanned = [row['table'] for row in rows if row['type'] == 'ALL']
+    else:
+        rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+        lines = [row[3] for row in rows]
+        scanned = []
+        for detail in lines:
+            match = re.match(r'SCAN (?:TABLE )?(\w+)', detail)
+            if match and 'INDEX' not in detail:
+                scanned.append(match.group(1))
+    return lines, [table for table in scanned if table in CHECKED_TABLES]
+
+
+def check_plans(min_rows):
+    """
+    Run every endpoint and EXPLAIN each distinct statement it issued. Return
+    the table sizes, [(path, statement, plan lines, tables read in full)]
+    (only tables of at least `min_rows` rows count) and the failed paths.
+    """
+    with db.engine.begin() as conn:
+        if conn.dialect.name == 'mysql':
+            conn.execute(text(f"ANALYZE TABLE {', '.join(CHECKED_TABLES)}"))
+        else:
+            conn.execute(text("ANALYZE"))
+        sizes = {table: conn.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar()
+                 for table in CHECKED_TABLES}
+
+    top = db.session.query(PasteMetadata.paste_id).order_by(PasteMetadata.last_seen.desc()).first()
+    paste_id = top[0] if top else 1
+
+    plans = []
+    seen = set()
+    captured, errors = capture_statements(paste_id)
+    with db.engine.connect() as conn:
+        for path, statement, parameters in captured:
+            if statement in seen:
+                continue
+            seen.add(statement)
+            lines, scanned = full_scans(conn, statement, parameters)
+            scanned = [table for table in scanned if sizes.get(table, 0) >= min_rows]
+            plans.append((path, statement, lines, scanned))
+    return sizes, plans, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seed', type=int, default=0, help="insert this many synthetic events first")
+    parser.add_argument('--min-rows', type=int, default=1000,
+                        help="ignore full scans of tables smaller than this")
+    parser.add_argument('--verbose', action='store_true', help="print every plan, not only the failures")
+    args = parser.parse_args()
+
+    with app.app_context():
+        migrations.run_migrations(db.engine)
+        if args.seed:
+            seed(args.seed)
+
+        sizes, plans, errors = check_plans(args.min_rows)
+        print("Table sizes: " + ", ".join(f"{table}={size}" for table, size in sizes.items()))
+        failures = 0
+        for path, statement, lines, scanned in plans:
+            if scanned:
+                failures += 1
+            if scanned or args.verbose:
+                print(f"\n{'FULL SCAN of ' + ', '.join(scanned) if scanned else 'ok'}: {path}")
+                print("  " + " ".join(statement.split()))
+                for line in lines:
+                    print(f"    {line}")
+
+        print(f"\nChecked {len(plans)} statements from {len(ENDPOINTS)} endpoint calls: "
+              f"{failures} with full table scans, {len(errors)} failed calls")
+    return 1 if failures or errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,121 @@
+"""
+Streaming export of raw view events.
+
+GET /api/export/events writes the events of a time range as NDJSON or CSV
+without holding the result in memory. Events are read in keyset pages of
+EXPORT_PAGE_SIZE rows (`WHERE id > :after ... ORDER BY id LIMIT :size`), so
+each page is a primary key range scan however deep into the export it is. A
+page is read on its own short-lived connection, which goes back to the pool
+before the page is written to the client, so a slow download never pins a
+database connection.
+
+Every exported record carries a `cursor`: an opaque token holding the
+export's filters and the id of that record. Passing it back as ?cursor=
+resumes the export right after that record, e.g. after a dropped connection.
+
+The response status is sent before the first page is read, so a page that
+fails to load cannot turn into an error status. The export then ends with an
+error record instead of silently stopping, and a client should treat only an
+export without one as complete:
+
+    NDJSON  {"error": "<message>", "cursor": "<token>"}
+    CSV     #error,<message>,<token>
+
+The token resumes the export after the last record that was written.
+"""
+import base64
+import csv
+import io
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+EXPORT_PAGE_SIZE = int(os.getenv('EXPORT_PAGE_SIZE', '5000'))
+# ?days= is clamped to [1, EXPORT_MAX_DAYS]
+EXPORT_MAX_DAYS = 3650
+
+CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+CSV_ERROR_MARKER = '#error'
+
+COLUMNS = (
+    'id', 'paste_id', 'short_url', 'timestamp', 'view_count', 'sample_weight',
+    'ip_address', 'user_id', 'session_id', 'referrer', 'referrer_domain',
+    'user_agent', 'browser', 'device', 'processing_time', 'metadata', 'cursor',
+)
+
+
+def encode_cursor(filters, after):
+    """Token that resumes an export with `filters` after event id `after`."""
+    payload = json.dumps(dict(filters, after=after), separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """Return (filters, after) of a cursor token; raise ValueError if it is not one."""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        after = int(payload.pop('after'))
+    except (ValueError, TypeError, KeyError, AttributeError):
+        raise ValueError("Invalid export cursor")
+    return payload, after
+
+
+def _csv_chunk(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+def error_record(fmt, message, cursor):
+    """The record that ends an export which failed partway."""
+    if fmt == 'csv':
+        return _csv_chunk([[CSV_ERROR_MARKER, message, cursor]])
+    return json.dumps({'error': message, 'cursor': cursor}, separators=(',', ':')) + '\n'
+
+
+def ends_with_error(body, fmt):
+    """Whether an exported body ends with an error record."""
+    last = body.rstrip('\r\n').rsplit('\n', 1)[-1]
+    if fmt == 'csv':
+        return last.startswith(CSV_ERROR_MARKER + ',')
+    return last.startswith('{"error":')
+
+
+def stream(fetch_page, to_record, filters, after, fmt, limit=None):
+    """
+    Yield the export as text chunks, one per page. fetch_page(after, size)
+    returns up to `size` rows with id > after in id order, and to_record(row)
+    turns a row into a dict with the COLUMNS except `cursor`. At most `limit`
+    records are written when it is given.
+    """
+    if fmt == 'csv':
+        yield _csv_chunk([COLUMNS])
+    sent = 0
+    while limit is None or sent < limit:
+        size = EXPORT_PAGE_SIZE if limit is None else min(EXPORT_PAGE_SIZE, limit - sent)
+        try:
+            rows = fetch_page(after, size)
+        except Exception as e:
+            logger.error(f"Export stopped after event {after}: {str(e)}")
+            yield error_record(fmt, "Export failed while reading events; resume from the cursor",
+                               encode_cursor(filters, after))
+            return
+        records = []
+        for row in rows:
+            record = to_record(row)
+            after = record['id']
+            record['cursor'] = encode_cursor(filters, after)
+            records.append(record)
+        if fmt == 'csv':
+            yield _csv_chunk([[record[column] for column in COLUMNS] for record in records])
+        else:
+            yield ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records)
+        sent += len(rows)
+        if len(rows) < size:
+            return
@@ -0,0 +1,35 @@
+"""
+Gunicorn settings for analytics-service.
+
+Run `flask init-db` once before starting the workers. Each worker imports the
+app itself (no preload), so database pools and Redis connections are created
+after the fork, on first use.
+
+Workers are threaded (gthread) rather than gevent: mysql-connector's C
+extension does its socket I/O outside Python, where gevent cannot switch
+greenlets, so every query would block the whole worker. A request holds one
+of the `threads` of its worker until it returns, so the long-lived SSE
+stream of the dashboard is served by live_app.py with its own settings
+(gunicorn.live.conf.py).
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5003')}"
+workers = int(os.getenv('GUNICORN_WORKERS', min(multiprocessing.cpu_count() * 2 + 1, 8)))
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+worker_tmp_dir = '/dev/shm'
+timeout = 30
+graceful_timeout = 20
+keepalive = 3
+max_requests = 10000
+max_requests_jitter = 1000
+accesslog = '-'
+errorlog = '-'
+loglevel = os.getenv('LOG_LEVEL', 'info')
+
+
+def post_worker_init(worker):
+    from app import start_background_workers
+    start_background_workers()
@@ -0,0 +1,26 @@
+"""
+Gunicorn settings for the live dashboard stream (live_app.py).
+
+    gunicorn -c gunicorn.live.conf.py live_app:app
+
+Workers are gevent: every open dashboard is a greenlet waiting on its queue,
+not a thread, so a worker holds up to LIVE_MAX_CLIENTS streams. live_app only
+uses redis-py, which gevent's monkey patching makes cooperative (unlike
+mysql-connector, see gunicorn.conf.py).
+"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5004')}"
+workers = int(os.getenv('GUNICORN_WORKERS', '2'))
+worker_class = 'gevent'
+# Room for LIVE_MAX_CLIENTS streams per worker, plus the 503s turning away
+# the ones above it and the health checks
+worker_connections = int(os.getenv('LIVE_MAX_CLIENTS', '500')) + 50
+worker_tmp_dir = '/dev/shm'
+timeout = 30
+# Streams never finish on their own: a restart cuts them, and browsers reconnect
+graceful_timeout = 5
+keepalive = 3
+accesslog = '-'
+errorlog = '-'
+loglevel = os.getenv('LOG_LEVEL', 'info')
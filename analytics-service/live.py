@@ -0,0 +1,163 @@
+"""
+Live dashboard updates over Server-Sent Events.
+
+The ingest path calls LivePublisher.record_view() for every view, which only
+bumps an in-process counter. Every LIVE_FLUSH_INTERVAL seconds, a flusher
+thread publishes one small delta to the Redis channel LIVE_CHANNEL. The
+delta holds the new views per paste since the last flush, their total and,
+when it changed, the top of the all-time ranking.
+
+The SSE connections are served by live_app.py, under gevent workers, so
+that open dashboards do not hold the threads of the stats app. Each of its
+worker processes runs one LiveHub: a single Redis subscription whose
+messages are fanned out to the queues of the SSE connections open on that
+worker. An open dashboard therefore costs one queue put per delta
+instead of a recomputation of the stats. A client that falls
+LIVE_CLIENT_QUEUE messages behind is disconnected. The browser then
+reconnects and starts from a fresh page load.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import redis
+
+import sketches
+
+logger = logging.getLogger(__name__)
+
+LIVE_CHANNEL = 'analytics:live'
+LIVE_FLUSH_INTERVAL = float(os.getenv('LIVE_FLUSH_INTERVAL', '1'))
+LIVE_KEEPALIVE_SECONDS = float(os.getenv('LIVE_KEEPALIVE_SECONDS', '15'))
+LIVE_CLIENT_QUEUE = int(os.getenv('LIVE_CLIENT_QUEUE', '100'))
+LIVE_MAX_CLIENTS = int(os.getenv('LIVE_MAX_CLIENTS', '500'))  # per live_app worker
+# Where the dashboard page opens the stream (live_app.py); no live updates when empty
+LIVE_STREAM_URL = os.getenv('LIVE_STREAM_URL', '')
+LIVE_MAX_PASTES = 100  # per-paste counts in one delta; the rest only go into the total
+LIVE_TOP_PASTES = 5
+
+
+class LivePublisher:
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.Lock()
+        self.views = {}
+        self.last_top = None
+        self.thread = None
+
+    def record_view(self, paste_id):
+        with self.lock:
+            self.views[paste_id] = self.views.get(paste_id, 0) + 1
+
+    def _top(self):
+        top = sketches.top_all_time(self.client, LIVE_TOP_PASTES)
+        short_urls = sketches.lookup_short_urls(self.client, [paste_id for paste_id, _ in top])
+        return [{'paste_id': paste_id, 'short_url': short_urls.get(paste_id), 'view_count': int(views)}
+                for paste_id, views in top]
+
+    def flush(self):
+        """Publish the views recorded since the last flush, if any."""
+        with self.lock:
+            views, self.views = self.views, {}
+        if not views:
+            return
+        busiest = sorted(views.items(), key=lambda item: item[1], reverse=True)[:LIVE_MAX_PASTES]
+        delta = {
+            'timestamp': time.time(),
+            'total': sum(views.values()),
+            'views': {str(paste_id): count for paste_id, count in busiest}
+        }
+        try:
+            top = self._top()
+            if top != self.last_top:
+                delta['top'] = self.last_top = top
+            self.client.publish(LIVE_CHANNEL, json.dumps(delta, separators=(',', ':')))
+        except redis.RedisError as e:
+            logger.warning(f"Failed to publish live update: {str(e)}")
+
+    def start(self):
+        def run():
+            while True:
+                time.sleep(LIVE_FLUSH_INTERVAL)
+                self.flush()
+
+        self.thread = threading.Thread(target=run, name='live-publisher', daemon=True)
+        self.thread.start()
+        return self.thread
+
+
+class _Client:
+    __slots__ = ('queue', 'dropped')
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=LIVE_CLIENT_QUEUE)
+        self.dropped = False
+
+
+class LiveHub:
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.thread = None
+
+    def subscribe(self):
+        """Register an SSE connection; returns None when this worker is at LIVE_MAX_CLIENTS."""
+        with self.lock:
+            if len(self.clients) >= LIVE_MAX_CLIENTS:
+                return None
+            client = _Client()
+            self.clients.add(client)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._listen, name='live-hub', daemon=True)
+                self.thread.start()
+        return client
+
+    def unsubscribe(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+    def _fan_out(self, message):
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            try:
+                client.queue.put_nowait(message)
+            except queue.Full:
+                client.dropped = True
+                self.unsubscribe(client)
+
+    def _listen(self):
+        while True:
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(LIVE_CHANNEL)
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message and message['type'] == 'message':
+                        self._fan_out(message['data'])
+            except Exception as e:
+                logger.warning(f"Live update subscription failed, resubscribing: {str(e)}")
+                time.sleep(1)
+            finally:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+
+    def events(self, client):
+        """SSE stream for a subscribed client, with a comment line as keepalive."""
+        try:
+            yield f"retry: {int(LIVE_KEEPALIVE_SECONDS * 1000)}\n\n"
+            while not client.dropped:
+                try:
+                    data = client.queue.get(timeout=LIVE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: delta\ndata: {data}\n\n"
+        finally:
+            self.unsubscribe(client)
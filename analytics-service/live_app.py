@@ -0,0 +1,62 @@
+"""
+Live dashboard stream of analytics-service, served apart from app.py.
+
+An SSE connection stays open for as long as its dashboard does. In the stats
+app each one would hold a thread of a gthread worker, so a few open
+dashboards would leave none for /api/track-view. This app only serves the
+stream, under gevent workers (see gunicorn.live.conf.py) where a connection
+is a greenlet, and only talks to Redis: no database driver blocks the worker.
+
+The dashboard page connects to LIVE_STREAM_URL (see live.py), so the two
+apps can run on different ports; LIVE_ALLOWED_ORIGIN is sent as
+Access-Control-Allow-Origin for that cross-origin request.
+"""
+import os
+
+import redis
+from flask import Flask, Response, jsonify
+
+import live
+
+REDIS_HOST = os.getenv('REDIS_HOST', 'redis')
+REDIS_PORT = int(os.getenv('REDIS_PORT', '6379'))
+REDIS_DB = int(os.getenv('REDIS_DB', '2'))
+LIVE_ALLOWED_ORIGIN = os.getenv('LIVE_ALLOWED_ORIGIN', '*')
+
+app = Flask(__name__)
+redis_client = redis.Redis(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    db=REDIS_DB,
+    decode_responses=True,
+    socket_timeout=1,
+    socket_connect_timeout=1
+)
+live_hub = live.LiveHub(redis_client)
+
+
+@app.route('/api/stream/dashboard', methods=['GET'])
+def stream_dashboard():
+    """
+    SSE: Push live view deltas to the dashboard
+
+    Each `delta` event carries the new views per paste since the previous
+    one, their total, and the top pastes when they changed (see live.py).
+    """
+    client = live_hub.subscribe()
+    if client is None:
+        return jsonify({
+            "status": "error",
+            "message": "Too many live dashboard connections"
+        }), 503
+    return Response(live_hub.events(client), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+        'Access-Control-Allow-Origin': LIVE_ALLOWED_ORIGIN
+    })
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    """Liveness, with the number of open streams on this worker."""
+    return jsonify({"status": "healthy", "clients": len(live_hub.clients)}), 200
@@ -0,0 +1,105 @@
+"""
+Load check: open live dashboards do not starve /api/track-view.
+
+Opens --streams SSE connections to the live stream (live_app.py) and keeps
+them open, then posts --views views to /api/track-view of the stats app
+(app.py) and times them. Exits non-zero if a stream could not be opened or
+was cut, or if a view failed or took longer than --max-latency seconds, so
+it can gate CI.
+
+    python live_load_check.py --streams 200 \\
+        --live-url http://localhost:5004 --analytics-url http://localhost:5003
+
+Use more streams than the stats app has threads in total (GUNICORN_WORKERS x
+GUNICORN_THREADS, 32 in docker-compose.yml): before the stream moved to its
+own gevent workers, that many dashboards held every thread. The views are
+real events for paste --paste-id: do not point it at production.
+"""
+import argparse
+import sys
+import threading
+import time
+
+import requests
+
+
+class Stream(threading.Thread):
+    """One dashboard: reads the SSE stream until stopped."""
+
+    def __init__(self, url):
+        super().__init__(daemon=True)
+        self.url = url
+        self.opened = threading.Event()
+        self.stopped = threading.Event()
+        self.connected = False
+        self.error = None
+
+    def run(self):
+        try:
+            with requests.get(self.url, stream=True, timeout=(5, 30)) as response:
+                if response.status_code != 200:
+                    self.error = f"HTTP {response.status_code}"
+                    return
+                self.connected = True
+                self.opened.set()
+                for _ in response.iter_lines():
+                    if self.stopped.is_set():
+                        return
+                self.error = "stream closed by the server"
+        except requests.RequestException as e:
+            self.error = str(e)
+        finally:
+            self.opened.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--live-url', default='http://localhost:5004', help="base URL of live_app")
+    parser.add_argument('--analytics-url', default='http://localhost:5003', help="base URL of the stats app")
+    parser.add_argument('--streams', type=int, default=200, help="SSE connections to hold open")
+    parser.add_argument('--views', type=int, default=50, help="views to post while they are open")
+    parser.add_argument('--paste-id', type=int, default=999999999, help="paste the views are recorded for")
+    parser.add_argument('--max-latency', type=float, default=2.0, help="slowest acceptable view, in seconds")
+    args = parser.parse_args()
+
+    streams = [Stream(f"{args.live_url}/api/stream/dashboard") for _ in range(args.streams)]
+    for stream in streams:
+        stream.start()
+    for stream in streams:
+        stream.opened.wait(10)
+    unopened = [stream for stream in streams if not stream.connected]
+    print(f"Opened {args.streams - len(unopened)} of {args.streams} streams")
+
+    latencies = []
+    failures = 0
+    for i in range(args.views):
+        started = time.perf_counter()
+        try:
+            response = requests.post(f"{args.analytics_url}/api/track-view", json={
+                'paste_id': args.paste_id,
+                'short_url': 'loadcheck',
+                'view_count': i + 1
+            }, timeout=args.max_latency * 5)
+            if response.status_code != 200:
+                print(f"ERROR track-view: HTTP {response.status_code}")
+                failures += 1
+        except requests.RequestException as e:
+            print(f"ERROR track-view: {str(e)}")
+            failures += 1
+        latencies.append(time.perf_counter() - started)
+
+    cut = [stream for stream in streams if stream.connected and stream.error]
+    for stream in streams:
+        stream.stopped.set()
+    latencies.sort()
+    slowest = latencies[-1] if latencies else 0.0
+    print(f"Posted {args.views} views with {args.streams} streams open: median "
+          f"{latencies[len(latencies) // 2] * 1000:.1f} ms, slowest {slowest * 1000:.1f} ms, "
+          f"{failures} failed")
+    for error in sorted({stream.error or "timed out" for stream in unopened + cut}):
+        print(f"ERROR stream: {error}")
+    return 1 if unopened or cut or failures or slowest > args.max_latency else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
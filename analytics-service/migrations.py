@@ -0,0 +1,292 @@
+"""
+Schema migrations for the analytics database.
+
+db.create_all() only creates missing tables, so changes to existing tables are
+applied here. Migrations run once, in version order, and are recorded in the
+schema_migrations table. A fresh database already gets the current schema from
+create_all(), so every migration has to be idempotent.
+"""
+import json
+import logging
+from datetime import datetime, timezone
+
+from sqlalchemy import bindparam, inspect, text
+
+import approximate
+import encoding
+import partitions
+import user_agents
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_BATCH_SIZE = 5000
+DICTIONARY_CACHE_LIMIT = 100000
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Register a migration function taking an open connection."""
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        return func
+    return decorator
+
+
+def _columns(conn, table):
+    return {column['name'] for column in inspect(conn).get_columns(table)}
+
+
+def _indexes(conn, table):
+    return {index['name'] for index in inspect(conn).get_indexes(table)}
+
+
+@migration(1, "Classify user agents into view_event.browser and view_event.device")
+def add_user_agent_classes(conn):
+    columns = _columns(conn, 'view_event')
+    for column in ('browser', 'device'):
+        if column not in columns:
+            conn.execute(text(f"ALTER TABLE view_event ADD COLUMN {column} SMALLINT NULL"))
+    if 'ix_view_event_timestamp_browser_device' not in _indexes(conn, 'view_event'):
+        conn.execute(text("CREATE INDEX ix_view_event_timestamp_browser_device "
+                          "ON view_event (timestamp, browser, device)"))
+    if 'user_agent' not in columns:
+        # Created after migration 3 replaced the string column; nothing to classify
+        return
+
+    # Walk the table by primary key so each batch is a bounded range read
+    last_id = 0
+    while True:
+        rows = conn.execute(text(
+            "SELECT id, user_agent FROM view_event "
+            "WHERE id > :last_id AND user_agent IS NOT NULL AND browser IS NULL "
+            "ORDER BY id LIMIT :limit"
+        ), {'last_id': last_id, 'limit': BACKFILL_BATCH_SIZE}).fetchall()
+        if not rows:
+            break
+
+        groups = {}
+        for event_id, user_agent in rows:
+            groups.setdefault(user_agents.classify(user_agent), []).append(event_id)
+        for (browser, device), ids in groups.items():
+            conn.execute(
+                text("UPDATE view_event SET browser = :browser, device = :device "
+                     "WHERE id IN ({})".format(', '.join(str(event_id) for event_id in ids))),
+                {'browser': browser, 'device': device}
+            )
+        last_id = rows[-1][0]
+
+
+@migration(2, "Partition view_event by timestamp range")
+def partition_view_events(conn):
+    partitions.partition_view_events(conn)
+
+
+COMPACT_COLUMNS = (
+    ('ip_bin', 'VARBINARY(16)'),
+    ('user_bin', 'BINARY(16)'),
+    ('session_bin', 'BINARY(16)'),
+    ('referrer_id', 'INTEGER'),
+    ('user_agent_id', 'INTEGER'),
+)
+LEGACY_COLUMNS = ('ip_address', 'user_id', 'session_id', 'referrer', 'user_agent')
+
+
+def _dictionary_ids(conn, table, values, cache):
+    """Resolve strings to ids in a dictionary table, inserting the missing ones."""
+    if len(cache) > DICTIONARY_CACHE_LIMIT:
+        cache.clear()
+    missing = {value for value in values if value is not None and value not in cache}
+    if missing:
+        cache.update(conn.execute(
+            text(f"SELECT value, id FROM {table} WHERE value IN :values")
+            .bindparams(bindparam('values', expanding=True)),
+            {'values': sorted(missing)}
+        ).fetchall())
+        for value in missing - cache.keys():
+            result = conn.execute(text(f"INSERT INTO {table} (value) VALUES (:value)"), {'value': value})
+            cache[value] = result.lastrowid
+    return cache
+
+
+def _create_readable_view(conn):
+    """Readable view with the original string columns, for ad-hoc queries (MySQL only)."""
+    if conn.dialect.name != 'mysql':
+        return
+    conn.execute(text(
+        "CREATE OR REPLACE VIEW view_event_readable AS "
+        "SELECT e.id, e.paste_id, e.short_url, e.view_count, "
+        "INET6_NTOA(e.ip_bin) AS ip_address, BIN_TO_UUID(e.user_bin) AS user_id, "
+        "BIN_TO_UUID(e.session_bin) AS session_id, r.value AS referrer, ua.value AS user_agent, "
+        "e.browser, e.device, e.timestamp, e.processed, e.processing_time, "
+        + ("e.sample_weight, " if 'sample_weight' in _columns(conn, 'view_event') else "")
+        + "e.metadata_json "
+        "FROM view_event e "
+        "LEFT JOIN referrer r ON r.id = e.referrer_id "
+        "LEFT JOIN user_agent ua ON ua.id = e.user_agent_id"
+    ))
+
+
+@migration(3, "Store view_event IPs, ids and strings in compact encodings")
+def compact_view_events(conn):
+    columns = _columns(conn, 'view_event')
+    for column, column_type in COMPACT_COLUMNS:
+        if column not in columns:
+            conn.execute(text(f"ALTER TABLE view_event ADD COLUMN {column} {column_type} NULL"))
+
+    legacy = [column for column in LEGACY_COLUMNS if column in columns]
+    if legacy:
+        referrers, agents = {}, {}
+        last_id = 0
+        while True:
+            rows = conn.execute(text(
+                "SELECT id, ip_address, user_id, session_id, referrer, user_agent FROM view_event "
+                "WHERE id > :last_id ORDER BY id LIMIT :limit"
+            ), {'last_id': last_id, 'limit': BACKFILL_BATCH_SIZE}).fetchall()
+            if not rows:
+                break
+
+            _dictionary_ids(conn, 'referrer', [encoding.clip(row.referrer) for row in rows], referrers)
+            _dictionary_ids(conn, 'user_agent', [encoding.clip(row.user_agent) for row in rows], agents)
+            conn.execute(text(
+                "UPDATE view_event SET ip_bin = :ip_bin, user_bin = :user_bin, session_bin = :session_bin, "
+                "referrer_id = :referrer_id, user_agent_id = :user_agent_id WHERE id = :id"
+            ), [{
+                'id': row.id,
+                'ip_bin': encoding.encode_ip(row.ip_address),
+                'user_bin': encoding.encode_uuid(row.user_id),
+                'session_bin': encoding.encode_uuid(row.session_id),
+                'referrer_id': referrers.get(encoding.clip(row.referrer)),
+                'user_agent_id': agents.get(encoding.clip(row.user_agent)),
+            } for row in rows])
+            last_id = rows[-1].id
+
+        for column in legacy:
+            conn.execute(text(f"ALTER TABLE view_event DROP COLUMN {column}"))
+
+    _create_readable_view(conn)
+
+
+@migration(4, "Build paste_metadata from existing view events")
+def build_paste_metadata(conn):
+    conn.execute(text(
+        "INSERT INTO paste_metadata (paste_id, short_url, first_seen, last_seen) "
+        "SELECT paste_id, MAX(short_url), MIN(timestamp), MAX(timestamp) FROM view_event "
+        "WHERE paste_id NOT IN (SELECT paste_id FROM paste_metadata) "
+        "GROUP BY paste_id"
+    ))
+
+    # Expiry used to be stored in each event's metadata_json
+    if 'metadata_json' not in _columns(conn, 'view_event'):
+        return
+    rows = conn.execute(text(
+        "SELECT DISTINCT paste_id, metadata_json FROM view_event WHERE metadata_json LIKE :pattern"
+    ), {'pattern': '%expires_at%'}).fetchall()
+    for paste_id, metadata_json in rows:
+        try:
+            expires_at = json.loads(metadata_json).get('expires_at')
+            expires_at = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
+        except (AttributeError, TypeError, ValueError):
+            continue
+        if expires_at.tzinfo is not None:
+            expires_at = expires_at.astimezone(timezone.utc).replace(tzinfo=None)
+        conn.execute(text("UPDATE paste_metadata SET expires_at = :expires_at WHERE paste_id = :paste_id"),
+                     {'expires_at': expires_at, 'paste_id': paste_id})
+
+
+@migration(5, "Add view_event.sample_weight for adaptive sampling")
+def add_sample_weight(conn):
+    if 'sample_weight' not in _columns(conn, 'view_event'):
+        conn.execute(text("ALTER TABLE view_event ADD COLUMN sample_weight FLOAT NOT NULL DEFAULT 1"))
+    _create_readable_view(conn)
+
+
+@migration(6, "Normalize referrers to domains and build referrer_daily")
+def add_referrer_domains(conn):
+    if 'referrer_domain_id' not in _columns(conn, 'view_event'):
+        conn.execute(text("ALTER TABLE view_event ADD COLUMN referrer_domain_id INTEGER NULL"))
+
+    # Map every referrer URL to its domain; events are then updated per referrer id
+    domains = {}
+    referrers = conn.execute(text("SELECT id, value FROM referrer ORDER BY id")).fetchall()
+    for start in range(0, len(referrers), BACKFILL_BATCH_SIZE):
+        batch = referrers[start:start + BACKFILL_BATCH_SIZE]
+        _dictionary_ids(conn, 'referrer_domain', [encoding.referrer_domain(value) for _, value in batch], domains)
+        by_domain = {}
+        for referrer_id, value in batch:
+            domain_id = domains.get(encoding.referrer_domain(value))
+            if domain_id is not None:
+                by_domain.setdefault(domain_id, []).append(referrer_id)
+        for domain_id, referrer_ids in by_domain.items():
+            conn.execute(
+                text("UPDATE view_event SET referrer_domain_id = :domain_id "
+                     "WHERE referrer_id IN :ids AND referrer_domain_id IS NULL")
+                .bindparams(bindparam('ids', expanding=True)),
+                {'domain_id': domain_id, 'ids': referrer_ids}
+            )
+
+    if conn.execute(text("SELECT COUNT(*) FROM referrer_daily")).scalar() == 0:
+        conn.execute(text(
+            "INSERT INTO referrer_daily (paste_id, day, referrer_domain_id, views) "
+            "SELECT paste_id, DATE(timestamp), COALESCE(referrer_domain_id, 0), SUM(sample_weight) "
+            "FROM view_event GROUP BY paste_id, DATE(timestamp), COALESCE(referrer_domain_id, 0)"
+        ))
+    _create_readable_view(conn)
+
+
+COVERING_INDEXES = (
+    ('view_event', 'ix_view_event_timestamp_paste', 'timestamp, paste_id, view_count, sample_weight'),
+    ('view_event', 'ix_view_event_paste_timestamp', 'paste_id, timestamp, session_bin, sample_weight'),
+    ('view_event', 'ix_view_event_timestamp_session', 'timestamp, session_bin, sample_weight'),
+    ('view_event', 'ix_view_event_timestamp_agent', 'timestamp, user_agent_id, browser, device, sample_weight'),
+    ('processing_error', 'ix_processing_error_timestamp', 'timestamp'),
+)
+# Left-prefixes of the covering indexes, or superseded by one
+REDUNDANT_INDEXES = (
+    ('view_event', 'ix_view_event_timestamp'),
+    ('view_event', 'ix_view_event_timestamp_browser_device'),
+)
+
+
+@migration(7, "Add covering indexes for the stats queries")
+def add_covering_indexes(conn):
+    for table, name, columns in COVERING_INDEXES:
+        if name not in _indexes(conn, table):
+            conn.execute(text(f"CREATE INDEX {name} ON {table} ({columns})"))
+    for table, name in REDUNDANT_INDEXES:
+        if name in _indexes(conn, table):
+            conn.execute(text(f"DROP INDEX {name} ON {table}" if conn.dialect.name == 'mysql'
+                              else f"DROP INDEX {name}"))
+
+
+@migration(8, "Sample existing events into event_sample for approximate stats")
+def sample_events(conn):
+    approximate.backfill(conn)
+
+
+def run_migrations(engine):
+    """Apply every pending migration and return the versions that ran."""
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, "
+            "description VARCHAR(255) NOT NULL, "
+            "applied_at DATETIME NOT NULL)"
+        ))
+        applied = {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+    ran = []
+    for version, description, func in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if version in applied:
+            continue
+        logger.info(f"Applying migration {version}: {description}")
+        with engine.begin() as conn:
+            func(conn)
+            conn.execute(
+                text("INSERT INTO schema_migrations (version, description, applied_at) "
+                     "VALUES (:version, :description, :applied_at)"),
+                {'version': version, 'description': description, 'applied_at': datetime.utcnow()}
+            )
+        ran.append(version)
+    return ran
+
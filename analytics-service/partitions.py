@@ -0,0 +1,176 @@
+"""
+Time-range partitioning of the view_event table.
+
+On MySQL, view_event is partitioned BY RANGE (TO_DAYS(timestamp)) into daily
+or monthly partitions (PARTITION_GRANULARITY) plus a trailing `p_future`
+catch-all. A background thread keeps PARTITIONS_AHEAD empty partitions ready.
+Events are kept forever by default. Retention is opt-in: with
+EVENT_RETENTION_DAYS set above 0, the thread drops whole partitions older than
+that, which is a metadata operation instead of a row-by-row DELETE. The
+dropped events are gone for good, so rollups, the event sample and exports
+only cover the retained days. Queries that filter on a raw `timestamp` range
+only touch the partitions covering that range.
+
+Other databases (e.g. SQLite during local development) are left unpartitioned.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+TABLE = 'view_event'
+FUTURE_PARTITION = 'p_future'
+
+PARTITION_GRANULARITY = os.getenv('PARTITION_GRANULARITY', 'day')  # 'day' or 'month'
+PARTITIONS_AHEAD = int(os.getenv('PARTITIONS_AHEAD', '7'))
+EVENT_RETENTION_DAYS = int(os.getenv('EVENT_RETENTION_DAYS', '0'))  # 0 keeps events forever
+PARTITION_MAINTENANCE_INTERVAL = int(os.getenv('PARTITION_MAINTENANCE_INTERVAL', '3600'))
+
+# MySQL's TO_DAYS() counts from year 0, Python ordinals from year 1
+TO_DAYS_OFFSET = 365
+
+
+def _to_days(day):
+    return day.toordinal() + TO_DAYS_OFFSET
+
+
+def _from_to_days(value):
+    return date.fromordinal(int(value) - TO_DAYS_OFFSET)
+
+
+def _period_start(day):
+    return day.replace(day=1) if PARTITION_GRANULARITY == 'month' else day
+
+
+def _next_period(day):
+    if PARTITION_GRANULARITY == 'month':
+        return (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+    return day + timedelta(days=1)
+
+
+def _partition_name(start):
+    return start.strftime('p%Y%m' if PARTITION_GRANULARITY == 'month' else 'p%Y%m%d')
+
+
+def _partition_definition(start):
+    """Partition holding [start, next period), named after its first day."""
+    return f"PARTITION {_partition_name(start)} VALUES LESS THAN ({_to_days(_next_period(start))})"
+
+
+def _is_mysql(conn):
+    return conn.dialect.name == 'mysql'
+
+
+def list_partitions(conn):
+    """Return (name, upper_bound_date) for each range partition, in order; p_future has None."""
+    rows = conn.execute(text(
+        "SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND PARTITION_NAME IS NOT NULL "
+        "ORDER BY PARTITION_ORDINAL_POSITION"
+    ), {'table': TABLE}).fetchall()
+    return [(name, None if description == 'MAXVALUE' else _from_to_days(description))
+            for name, description in rows]
+
+
+def partition_view_events(conn):
+    """
+    Convert view_event into a range-partitioned table. Everything older than
+    today lands in a single `p_history` partition that retention drops once
+    all of it has aged out.
+    """
+    if not _is_mysql(conn) or list_partitions(conn):
+        return
+
+    # Every unique key of a partitioned table must include the partitioning column
+    conn.execute(text(f"ALTER TABLE {TABLE} DROP PRIMARY KEY, ADD PRIMARY KEY (id, timestamp)"))
+
+    today = _period_start(datetime.utcnow().date())
+    definitions = [f"PARTITION p_history VALUES LESS THAN ({_to_days(today)})"]
+    start = today
+    for _ in range(PARTITIONS_AHEAD + 1):
+        definitions.append(_partition_definition(start))
+        start = _next_period(start)
+    definitions.append(f"PARTITION {FUTURE_PARTITION} VALUES LESS THAN MAXVALUE")
+
+    conn.execute(text(
+        f"ALTER TABLE {TABLE} PARTITION BY RANGE (TO_DAYS(timestamp)) ({', '.join(definitions)})"
+    ))
+
+
+def add_future_partitions(conn, today=None):
+    """Split p_future so partitions exist through PARTITIONS_AHEAD periods from today."""
+    partitions = list_partitions(conn)
+    bounds = [bound for _, bound in partitions if bound is not None]
+    if not bounds:
+        return []
+
+    today = today or datetime.utcnow().date()
+    horizon = _period_start(today)
+    for _ in range(PARTITIONS_AHEAD + 1):
+        horizon = _next_period(horizon)
+
+    start = max(bounds)
+    definitions = []
+    while start < horizon:
+        definitions.append(_partition_definition(start))
+        start = _next_period(start)
+    if not definitions:
+        return []
+
+    definitions.append(f"PARTITION {FUTURE_PARTITION} VALUES LESS THAN MAXVALUE")
+    conn.execute(text(
+        f"ALTER TABLE {TABLE} REORGANIZE PARTITION {FUTURE_PARTITION} INTO ({', '.join(definitions)})"
+    ))
+    return definitions
+
+
+def drop_expired_partitions(conn, today=None):
+    """Drop partitions whose rows are all older than EVENT_RETENTION_DAYS."""
+    if EVENT_RETENTION_DAYS <= 0:
+        return []
+
+    cutoff = (today or datetime.utcnow().date()) - timedelta(days=EVENT_RETENTION_DAYS)
+    expired = [name for name, bound in list_partitions(conn)
+               if bound is not None and bound <= cutoff]
+    if expired:
+        conn.execute(text(f"ALTER TABLE {TABLE} DROP PARTITION {', '.join(expired)}"))
+    return expired
+
+
+def maintain_partitions(engine):
+    """Create upcoming partitions and drop expired ones, once across all processes."""
+    with engine.connect() as conn:
+        if not _is_mysql(conn):
+            return
+        # Partition DDL from several workers at once would conflict
+        if not conn.execute(text("SELECT GET_LOCK('analytics_partition_maintenance', 0)")).scalar():
+            return
+        try:
+            added = add_future_partitions(conn)
+            dropped = drop_expired_partitions(conn)
+            if added:
+                logger.info(f"Added {len(added) - 1} partitions to {TABLE}")
+            if dropped:
+                logger.info(f"Dropped expired partitions {', '.join(dropped)} from {TABLE}")
+        finally:
+            conn.execute(text("SELECT RELEASE_LOCK('analytics_partition_maintenance')"))
+
+
+def start_maintenance(engine):
+    """Run maintain_partitions() now and then every PARTITION_MAINTENANCE_INTERVAL seconds."""
+    def run():
+        while True:
+            try:
+                maintain_partitions(engine)
+            except Exception as e:
+                logger.error(f"Partition maintenance failed: {str(e)}")
+            time.sleep(PARTITION_MAINTENANCE_INTERVAL)
+
+    thread = threading.Thread(target=run, name='partition-maintenance', daemon=True)
+    thread.start()
+    return thread
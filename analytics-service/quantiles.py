@@ -0,0 +1,78 @@
+"""
+Mergeable quantile sketch for the analytics stats endpoints.
+
+A DDSketch-style log-bucket sketch: a positive value v falls into bucket
+ceil(log(v) / log(gamma)) with gamma = (1 + alpha) / (1 - alpha), and every
+bucket's representative value is within a relative error of alpha of the
+values it holds. Zero (and negative) values are kept in a separate zero bucket.
+
+The bucket index is a plain arithmetic expression, so the database can
+compute it and GROUP BY it. The sketch is then filled from at most a few
+hundred (bucket, count) rows instead of one row per value. Sketches with the
+same alpha merge by adding bucket counts.
+"""
+import math
+import os
+
+QUANTILE_RELATIVE_ACCURACY = float(os.getenv('QUANTILE_RELATIVE_ACCURACY', '0.01'))
+
+
+class LogBucketSketch:
+    def __init__(self, relative_accuracy=QUANTILE_RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def bucket_index(self, value):
+        """Bucket of a value, or None for the zero bucket."""
+        if value <= 0:
+            return None
+        return math.ceil(math.log(value) / self.log_gamma)
+
+    def add(self, value, count=1):
+        self.add_bucket(self.bucket_index(value), count)
+
+    def add_bucket(self, index, count):
+        """Add count values to a bucket as computed by bucket_index() or by the database."""
+        if not count:
+            return
+        if index is None:
+            self.zero_count += count
+        else:
+            index = int(index)
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += count
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError("Cannot merge sketches with different relative accuracy")
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        return self
+
+    def _bucket_value(self, index):
+        # Midpoint of (gamma^(i-1), gamma^i] in the relative-error sense
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def quantile(self, q):
+        """Estimate the q-quantile (0 <= q <= 1); None for an empty sketch."""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return self._bucket_value(index)
+        return self._bucket_value(max(self.buckets))
+
+    def quantiles(self, qs=(0.5, 0.9, 0.99)):
+        """Map of 'p50'-style labels to estimates."""
+        return {f"p{round(q * 100):g}": self.quantile(q) for q in qs}
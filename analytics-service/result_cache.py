@@ -0,0 +1,211 @@
+"""
+Response cache for the analytics stats endpoints.
+
+Responses are cached in Redis under the endpoint name and the normalized
+request path and query string. Each entry records the ingest watermark it was
+computed at. Per paste, the watermark is a counter that ingest bumps with every
+event, so a paste's entries are served until new events land for it. Globally
+it is the GLOBAL_TICK_SECONDS tick of the latest event: counting every event
+would invalidate global stats continuously under steady ingest, so global
+entries are instead at most one tick out of date.
+
+Expensive endpoints cache the value of their query function instead, with
+stale-while-revalidate (see ResultCache.stale_while_revalidate): once the
+watermark moves, the previous value is still served for up to STALE_TTL
+seconds while a single background thread recomputes it by calling the query
+function again with the same arguments. Hits, stale hits and misses are
+counted per endpoint.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from functools import wraps
+
+import redis
+from flask import current_app, make_response, request
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'analytics:cache'
+STATS_KEY = f"{KEY_PREFIX}:stats"
+WATERMARK_KEY = 'analytics:ingest:watermark'
+
+# Entries expire after MAX_AGE seconds even without new events, so that
+# "today"/"this week" boundaries roll over on quiet systems
+MAX_AGE = int(os.getenv('RESULT_CACHE_MAX_AGE', '300'))
+STALE_TTL = int(os.getenv('RESULT_CACHE_STALE_TTL', '30'))
+REFRESH_LOCK_TTL = 60
+GLOBAL_TICK_SECONDS = int(os.getenv('RESULT_CACHE_GLOBAL_TICK', '10'))
+
+
+def watermark_key(paste_id=None):
+    return WATERMARK_KEY if paste_id is None else f"{WATERMARK_KEY}:{paste_id}"
+
+
+def _tick(moment=None):
+    return int((time.time() if moment is None else moment) // GLOBAL_TICK_SECONDS)
+
+
+def _decoded(value):
+    """`value` as it reads back from the cache: encoded like jsonify, then decoded."""
+    return json.loads(current_app.json.dumps(value))
+
+
+def bump_watermark(client, paste_id):
+    """Record that events changed for a paste (and therefore globally)."""
+    pipe = client.pipeline(transaction=False)
+    pipe.set(watermark_key(), _tick())
+    pipe.incr(watermark_key(paste_id))
+    pipe.execute()
+
+
+class ResultCache:
+    def __init__(self, client):
+        self.client = client
+        self.enabled = True  # explain_queries turns the cache off to run every query
+
+    def _watermark(self, paste_id):
+        return int(self.client.get(watermark_key(paste_id)) or 0)
+
+    def _fresh(self, entry, watermark, paste_id):
+        if entry['watermark'] != watermark:
+            return False
+        if paste_id is not None:
+            return True
+        # Events later in the tick the entry was computed in leave the global
+        # watermark as it was, so such an entry is only good until the tick ends
+        created = _tick(entry['created'])
+        return created > watermark or created == _tick()
+
+    def _count(self, endpoint, outcome):
+        self.client.hincrby(STATS_KEY, f"{endpoint}:{outcome}", 1)
+
+    def stats(self):
+        """Per-endpoint hits, stale hits, misses and hit rate."""
+        counters = {}
+        for field, value in self.client.hgetall(STATS_KEY).items():
+            endpoint, outcome = field.rsplit(':', 1)
+            counters.setdefault(endpoint, {'hit': 0, 'stale': 0, 'miss': 0})[outcome] = int(value)
+        result = {}
+        for endpoint, counts in sorted(counters.items()):
+            total = counts['hit'] + counts['stale'] + counts['miss']
+            result[endpoint] = {
+                'hits': counts['hit'],
+                'stale_hits': counts['stale'],
+                'misses': counts['miss'],
+                'hit_rate': round((counts['hit'] + counts['stale']) / total, 4) if total else 0.0
+            }
+        return result
+
+    def _store(self, key, watermark, started, **fields):
+        """Store an entry computed from the data as of `started`, when `watermark` was read."""
+        entry = dict(fields, watermark=watermark, created=started)
+        self.client.setex(key, MAX_AGE, json.dumps(entry))
+
+    def _refresh_in_background(self, key, query, args, paste_id):
+        """Recompute query(*args) on a thread unless another worker is already doing it."""
+        if not self.client.set(f"{key}:refresh", 1, nx=True, ex=REFRESH_LOCK_TTL):
+            return
+        app = current_app._get_current_object()
+
+        def refresh():
+            try:
+                with app.app_context():
+                    started = time.time()
+                    watermark = self._watermark(paste_id)
+                    self._store(key, watermark, started, value=_decoded(query(*args)))
+            except Exception:
+                logger.exception(f"Background refresh of {query.__name__}{tuple(args)} failed")
+            finally:
+                try:
+                    self.client.delete(f"{key}:refresh")
+                except redis.RedisError as e:
+                    logger.warning(f"Failed to release the refresh of {query.__name__}: {str(e)}")
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def stale_while_revalidate(self, endpoint, query, *args, paste_id=None):
+        """
+        query(*args), cached under `endpoint` and `args` until the watermark
+        of `paste_id` (or the global one) moves, then still returned for up
+        to STALE_TTL seconds while a background thread calls query(*args)
+        again. The value must be JSON-serializable and is returned as decoded
+        from JSON, cached or not. Returns (value, 'hit' | 'stale' | 'miss').
+        """
+        digest = hashlib.sha1(json.dumps([query.__name__, args]).encode('utf-8')).hexdigest()
+        key = f"{KEY_PREFIX}:{endpoint}:{digest}"
+        if not self.enabled:
+            return _decoded(query(*args)), 'miss'
+
+        try:
+            started = time.time()
+            watermark = self._watermark(paste_id)
+            cached = self.client.get(key)
+        except redis.RedisError as e:
+            logger.warning(f"Result cache unavailable for {endpoint}: {str(e)}")
+            return _decoded(query(*args)), 'miss'
+
+        if cached:
+            entry = json.loads(cached)
+            outcome = None
+            if self._fresh(entry, watermark, paste_id):
+                outcome = 'hit'
+            elif time.time() - entry['created'] < STALE_TTL:
+                outcome = 'stale'
+                self._refresh_in_background(key, query, args, paste_id)
+            if outcome:
+                self._count(endpoint, outcome)
+                return entry['value'], outcome
+
+        value = _decoded(query(*args))
+        try:
+            self._store(key, watermark, started, value=value)
+            self._count(endpoint, 'miss')
+        except redis.RedisError as e:
+            logger.warning(f"Failed to cache {endpoint}: {str(e)}")
+        return value, 'miss'
+
+    def cached(self, endpoint):
+        """Cache a view's response until the ingest watermark for its scope moves."""
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return view(*args, **kwargs)
+                paste_id = kwargs.get('paste_id', request.args.get('paste_id', type=int))
+                params = sorted((k, v) for k, v in request.args.items(multi=True) if v != '')
+                digest = hashlib.sha1(json.dumps([request.path, params]).encode('utf-8')).hexdigest()
+                key = f"{KEY_PREFIX}:{endpoint}:{digest}"
+
+                try:
+                    started = time.time()
+                    watermark = self._watermark(paste_id)
+                    cached = self.client.get(key)
+                except redis.RedisError as e:
+                    logger.warning(f"Result cache unavailable for {endpoint}: {str(e)}")
+                    return view(*args, **kwargs)
+
+                if cached:
+                    entry = json.loads(cached)
+                    if self._fresh(entry, watermark, paste_id):
+                        self._count(endpoint, 'hit')
+                        response = current_app.response_class(entry['body'], status=entry['status'],
+                                                              mimetype=entry['mimetype'])
+                        response.headers['X-Cache'] = 'HIT'
+                        return response
+
+                response = make_response(view(*args, **kwargs))
+                if response.status_code == 200:
+                    try:
+                        self._store(key, watermark, started, status=response.status_code,
+                                    mimetype=response.mimetype, body=response.get_data(as_text=True))
+                        self._count(endpoint, 'miss')
+                    except redis.RedisError as e:
+                        logger.warning(f"Failed to cache {endpoint}: {str(e)}")
+                response.headers['X-Cache'] = 'MISS'
+                return response
+            return wrapper
+        return decorator
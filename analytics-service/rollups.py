@@ -0,0 +1,283 @@
+"""
+Parallel rebuild of the aggregates derived from view_event.
+
+`flask rebuild-rollups` recomputes a rollup (referrer_daily, or event_sample
+with sample_stratum) from the raw events, e.g. after its definition changed
+or after an ingest outage:
+
+1. The days in [since, until) are split into ranges of --range-days.
+2. A process pool builds each range into shadow tables (<table>_rebuild).
+   Each range is one transaction that also records it in
+   rollup_rebuild_range, so an interrupted run continues with --resume.
+3. Once every range is built, the shadow tables replace the live ones. Rows
+   outside [since, until) are carried over from the live tables; those of
+   `until` and later (still receiving ingest) are copied under a table lock
+   right before the swap. On MySQL the swap is a single RENAME TABLE;
+   elsewhere the rows are replaced in one transaction.
+
+--average-rate paces the rebuild to leave room for live ingestion: after a
+range, its worker sleeps until the range's estimated events over the time
+spent match the worker's share of the rate. It is an average, not a cap:
+each range is one INSERT ... SELECT that reads its events at full speed, so
+smaller --range-days keep the bursts shorter. --dry-run only prints the
+estimated events per range, taken from the event sample strata.
+"""
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool
+
+import approximate
+import deletions
+
+logger = logging.getLogger(__name__)
+
+
+def _build_referrer_daily(conn, tables, start_day, end_day):
+    return conn.execute(text(
+        f"INSERT INTO {tables['referrer_daily']} (paste_id, day, referrer_domain_id, views) "
+        "SELECT paste_id, DATE(timestamp), COALESCE(referrer_domain_id, 0), SUM(sample_weight) "
+        "FROM view_event WHERE timestamp >= :start AND timestamp < :end "
+        "GROUP BY paste_id, DATE(timestamp), COALESCE(referrer_domain_id, 0)"
+    ), {'start': datetime.combine(start_day, datetime.min.time()),
+        'end': datetime.combine(end_day, datetime.min.time())}).rowcount
+
+
+def _build_event_sample(conn, tables, start_day, end_day):
+    rows = 0
+    for day, events in approximate.events_per_day(conn, datetime.combine(start_day, datetime.min.time()),
+                                                  datetime.combine(end_day, datetime.min.time())):
+        rows += approximate.sample_day(conn, day, events, sample_table=tables['event_sample'],
+                                       stratum_table=tables['sample_stratum'])
+    return rows
+
+
+# Rollup name -> its tables with the columns copied between live and shadow
+# tables (autoincrement ids are left out), and the function building a range
+ROLLUPS = {
+    'referrer_daily': {
+        'tables': {'referrer_daily': ('paste_id', 'day', 'referrer_domain_id', 'views')},
+        'build': _build_referrer_daily,
+    },
+    'event_sample': {
+        'tables': {
+            'event_sample': ('day', 'u', 'paste_id', 'device', 'browser', 'sample_weight'),
+            'sample_stratum': ('day', 'threshold', 'sampled_rows', 'updated_at'),
+        },
+        'build': _build_event_sample,
+    },
+}
+
+# Tables whose rows belong to a paste, cleared when its deletion finishes during the rebuild
+PASTE_TABLES = ('referrer_daily', 'event_sample')
+
+
+def shadow_name(table):
+    return f"{table}_rebuild"
+
+
+def split_ranges(since, until, range_days):
+    ranges = []
+    start = since
+    while start < until:
+        end = min(start + timedelta(days=range_days), until)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def estimate_events(conn, ranges):
+    """Events per range from the event sample strata, or COUNT(*) for days without one."""
+    strata = {str(day): (threshold, rows) for day, threshold, rows in conn.execute(text(
+        "SELECT day, threshold, sampled_rows FROM sample_stratum WHERE day >= :since AND day < :until"
+    ), {'since': ranges[0][0], 'until': ranges[-1][1]})}
+    estimates = []
+    for start, end in ranges:
+        events = 0
+        day = start
+        while day < end:
+            threshold, rows = strata.get(str(day), (None, None))
+            if threshold:
+                events += rows / threshold
+            else:
+                day_start = datetime.combine(day, datetime.min.time())
+                events += conn.execute(text(
+                    "SELECT COUNT(*) FROM view_event WHERE timestamp >= :start AND timestamp < :end"
+                ), {'start': day_start, 'end': day_start + timedelta(days=1)}).scalar()
+            day += timedelta(days=1)
+        estimates.append(int(events))
+    return estimates
+
+
+def _prepare(engine, name, since, until, range_days, resume):
+    """Create the shadow tables and the run record, or check them when resuming; return the done ranges."""
+    tables = ROLLUPS[name]['tables']
+    with engine.begin() as conn:
+        run = conn.execute(text(
+            "SELECT since_day, until_day, range_days, status FROM rollup_rebuild WHERE rollup = :name"
+        ), {'name': name}).fetchone()
+        if resume:
+            if run is None or run.status != 'running':
+                raise ValueError(f"No interrupted rebuild of {name} to resume")
+            if str(run.since_day) != str(since) or str(run.until_day) != str(until) or run.range_days != range_days:
+                raise ValueError(f"The interrupted rebuild of {name} covered {run.since_day} to {run.until_day} "
+                                 f"in ranges of {run.range_days} days")
+            return {str(row[0]) for row in conn.execute(text(
+                "SELECT range_start FROM rollup_rebuild_range WHERE rollup = :name"
+            ), {'name': name})}
+
+        conn.execute(text("DELETE FROM rollup_rebuild_range WHERE rollup = :name"), {'name': name})
+        conn.execute(text("DELETE FROM rollup_rebuild WHERE rollup = :name"), {'name': name})
+        conn.execute(text(
+            "INSERT INTO rollup_rebuild (rollup, since_day, until_day, range_days, status, started_at) "
+            "VALUES (:name, :since, :until, :range_days, 'running', :now)"
+        ), {'name': name, 'since': since, 'until': until, 'range_days': range_days, 'now': datetime.utcnow()})
+        for table in tables:
+            conn.execute(text(f"DROP TABLE IF EXISTS {shadow_name(table)}"))
+            if conn.dialect.name == 'mysql':
+                conn.execute(text(f"CREATE TABLE {shadow_name(table)} LIKE {table}"))
+            else:
+                # Staging only: rows are copied back into the live table at the swap
+                conn.execute(text(f"CREATE TABLE {shadow_name(table)} AS SELECT * FROM {table} WHERE 1 = 0"))
+    return set()
+
+
+_worker_engine = None
+
+
+def _init_worker(url):
+    global _worker_engine
+    connect_args = {'timeout': 60} if url.startswith('sqlite') else {}
+    _worker_engine = create_engine(url, poolclass=NullPool, connect_args=connect_args)
+
+
+def _build_range(name, start, end, events, rows_per_second):
+    """Build one range into the shadow tables (runs in a pool process)."""
+    started = time.monotonic()
+    tables = {table: shadow_name(table) for table in ROLLUPS[name]['tables']}
+    with _worker_engine.begin() as conn:
+        rows = ROLLUPS[name]['build'](conn, tables, start, end)
+        conn.execute(text(
+            "INSERT INTO rollup_rebuild_range (rollup, range_start, range_end, rows_written, finished_at) "
+            "VALUES (:name, :start, :end, :rows, :now)"
+        ), {'name': name, 'start': start, 'end': end, 'rows': rows, 'now': datetime.utcnow()})
+    elapsed = time.monotonic() - started
+    if rows_per_second:
+        # Average out to this process's share of --average-rate
+        time.sleep(max(0.0, events / rows_per_second - elapsed))
+    return start, end, rows, elapsed
+
+
+def _swap(engine, name, since, until, started_at):
+    tables = ROLLUPS[name]['tables']
+    with engine.begin() as conn:
+        # Days before the rebuilt range are closed; carry them over without a lock
+        for table, columns in tables.items():
+            cols = ', '.join(columns)
+            conn.execute(text(
+                f"INSERT INTO {shadow_name(table)} ({cols}) SELECT {cols} FROM {table} WHERE day < :since"
+            ), {'since': since})
+            if table in PASTE_TABLES:
+                conn.execute(text(
+                    f"DELETE FROM {shadow_name(table)} WHERE paste_id IN "
+                    "(SELECT paste_id FROM deletion_job WHERE status = :done AND finished_at >= :started)"
+                ), {'done': deletions.DONE, 'started': started_at})
+
+    if engine.dialect.name == 'mysql':
+        with engine.connect() as conn:
+            locks = ', '.join(f"{table} WRITE, {shadow_name(table)} WRITE" for table in tables)
+            conn.exec_driver_sql(f"LOCK TABLES {locks}")
+            try:
+                for table, columns in tables.items():
+                    cols = ', '.join(columns)
+                    conn.execute(text(
+                        f"INSERT INTO {shadow_name(table)} ({cols}) SELECT {cols} FROM {table} WHERE day >= :until"
+                    ), {'until': until})
+                renames = ', '.join(f"{table} TO {table}_old, {shadow_name(table)} TO {table}" for table in tables)
+                conn.exec_driver_sql(f"RENAME TABLE {renames}")
+            finally:
+                conn.exec_driver_sql("UNLOCK TABLES")
+            for table in tables:
+                conn.exec_driver_sql(f"DROP TABLE IF EXISTS {table}_old")
+    else:
+        with engine.begin() as conn:
+            for table, columns in tables.items():
+                cols = ', '.join(columns)
+                conn.execute(text(f"DELETE FROM {table} WHERE day < :until"), {'until': until})
+                conn.execute(text(
+                    f"INSERT INTO {table} ({cols}) SELECT {cols} FROM {shadow_name(table)} WHERE day < :until"
+                ), {'until': until})
+                conn.execute(text(f"DROP TABLE {shadow_name(table)}"))
+
+    with engine.begin() as conn:
+        conn.execute(text(
+            "UPDATE rollup_rebuild SET status = 'done', finished_at = :now WHERE rollup = :name"
+        ), {'name': name, 'now': datetime.utcnow()})
+
+
+def _defaults(engine, name, since, until, range_days, resume):
+    """
+    Fill in since, until and range_days: the interrupted run's when resuming,
+    else the first event's day, today and one day.
+    """
+    with engine.connect() as conn:
+        if resume:
+            run = conn.execute(text(
+                "SELECT since_day, until_day, range_days FROM rollup_rebuild WHERE rollup = :name"
+            ), {'name': name}).fetchone()
+            if run is not None:
+                since = since or datetime.strptime(str(run.since_day), '%Y-%m-%d').date()
+                until = until or datetime.strptime(str(run.until_day), '%Y-%m-%d').date()
+                range_days = range_days or run.range_days
+        if since is None:
+            first = conn.execute(text("SELECT MIN(timestamp) FROM view_event")).scalar()
+            if isinstance(first, str):
+                first = datetime.fromisoformat(first)
+            since = first.date() if first else datetime.utcnow().date()
+    return since, until or datetime.utcnow().date(), range_days or 1
+
+
+def rebuild(engine, name, since=None, until=None, workers=4, range_days=None, average_rate=0, dry_run=False,
+            resume=False, echo=print):
+    """Rebuild rollup `name` for the days in [since, until); see the module docstring."""
+    if name not in ROLLUPS:
+        raise ValueError(f"Unknown rollup '{name}'; use one of {', '.join(ROLLUPS)}")
+    since, until, range_days = _defaults(engine, name, since, until, range_days, resume)
+    ranges = split_ranges(since, until, range_days)
+    if not ranges:
+        echo(f"{name}: nothing to rebuild between {since} and {until}")
+        return
+    with engine.connect() as conn:
+        estimates = estimate_events(conn, ranges)
+
+    if dry_run:
+        for (start, end), events in zip(ranges, estimates):
+            echo(f"{name}: {start} to {end}: ~{events} events")
+        total = sum(estimates)
+        eta = f", at least {total / average_rate:.0f}s at --average-rate {average_rate}" if average_rate else ""
+        echo(f"{name}: {len(ranges)} ranges, ~{total} events to read{eta}")
+        return
+
+    done = _prepare(engine, name, since, until, range_days, resume)
+    with engine.connect() as conn:
+        started_at = conn.execute(text("SELECT started_at FROM rollup_rebuild WHERE rollup = :name"),
+                                  {'name': name}).scalar()
+    pending = [(start, end, events) for (start, end), events in zip(ranges, estimates) if str(start) not in done]
+    echo(f"{name}: {len(pending)} of {len(ranges)} ranges to build with {workers} workers")
+
+    url = engine.url.render_as_string(hide_password=False)
+    per_worker = average_rate / workers if average_rate else 0
+    built = len(ranges) - len(pending)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(url,)) as pool:
+        futures = [pool.submit(_build_range, name, start, end, events, per_worker)
+                   for start, end, events in pending]
+        for future in as_completed(futures):
+            start, end, rows, elapsed = future.result()
+            built += 1
+            echo(f"{name}: built {start} to {end}: {rows} rows in {elapsed:.1f}s ({built}/{len(ranges)})")
+
+    _swap(engine, name, since, until, started_at)
+    echo(f"{name}: swapped in the rebuilt tables")
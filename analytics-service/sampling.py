@@ -0,0 +1,122 @@
+"""
+Adaptive sampling of view events under load.
+
+Normally every view is stored. The sampler watches the database writes of
+the ingest path in this process: their latency and error rate (as moving
+averages) and how many are in flight at once. Every SAMPLING_ADJUST_INTERVAL
+seconds it adjusts the fraction of view events that are stored:
+
+- If any signal crosses its high threshold, the rate is halved, down to
+  SAMPLING_MIN_RATE.
+- Once all signals are back under their low thresholds, the rate is doubled
+  again, up to full fidelity.
+
+An event kept at rate r is stored with sample_weight = 1 / r. Aggregates sum
+the weights instead of counting rows, so their totals stay unbiased.
+"""
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+SAMPLING_ENABLED = os.getenv('SAMPLING_ENABLED', 'true').lower() == 'true'
+SAMPLING_MIN_RATE = float(os.getenv('SAMPLING_MIN_RATE', '0.01'))
+SAMPLING_ADJUST_INTERVAL = float(os.getenv('SAMPLING_ADJUST_INTERVAL', '5'))
+SAMPLING_LATENCY_HIGH_MS = float(os.getenv('SAMPLING_LATENCY_HIGH_MS', '250'))
+SAMPLING_LATENCY_LOW_MS = float(os.getenv('SAMPLING_LATENCY_LOW_MS', '50'))
+SAMPLING_IN_FLIGHT_HIGH = int(os.getenv('SAMPLING_IN_FLIGHT_HIGH', '32'))
+SAMPLING_ERROR_RATE_HIGH = float(os.getenv('SAMPLING_ERROR_RATE_HIGH', '0.05'))
+
+# Weight of the newest observation in the moving averages
+EWMA_ALPHA = 0.2
+
+
+class AdaptiveSampler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rate = 1.0
+        self.in_flight = 0
+        self.latency_ms = 0.0
+        self.error_rate = 0.0
+        self.observed = 0
+        self.kept = 0
+        self.dropped = 0
+        self.last_adjust = time.monotonic()
+        self.last_change = None
+
+    @property
+    def sampling(self):
+        """True while only a fraction of events is being stored."""
+        return self.rate < 1.0
+
+    def _overloaded(self):
+        return (self.latency_ms > SAMPLING_LATENCY_HIGH_MS
+                or self.in_flight >= SAMPLING_IN_FLIGHT_HIGH
+                or self.error_rate > SAMPLING_ERROR_RATE_HIGH)
+
+    def _recovered(self):
+        if self.in_flight >= SAMPLING_IN_FLIGHT_HIGH // 2:
+            return False
+        # Without writes in the last interval there is no load to back off from
+        return not self.observed or (self.latency_ms < SAMPLING_LATENCY_LOW_MS
+                                     and self.error_rate < SAMPLING_ERROR_RATE_HIGH / 2)
+
+    def _adjust(self, now):
+        previous = self.rate
+        if self._overloaded():
+            self.rate = max(SAMPLING_MIN_RATE, self.rate / 2)
+        elif self.rate < 1.0 and self._recovered():
+            self.rate = min(1.0, self.rate * 2)
+        if self.rate != previous:
+            self.last_change = time.time()
+        self.observed = 0
+        self.last_adjust = now
+
+    def sample(self):
+        """Return the weight to store the next event with, or None to drop it."""
+        if not SAMPLING_ENABLED:
+            return 1.0
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_adjust >= SAMPLING_ADJUST_INTERVAL:
+                self._adjust(now)
+            rate = self.rate
+            keep = rate >= 1.0 or random.random() < rate
+            if keep:
+                self.kept += 1
+            else:
+                self.dropped += 1
+        return 1.0 / rate if keep else None
+
+    @contextmanager
+    def writing(self):
+        """Wrap an event's database write to feed its latency and outcome to the sampler."""
+        with self.lock:
+            self.in_flight += 1
+        started = time.perf_counter()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with self.lock:
+                self.in_flight -= 1
+                self.observed += 1
+                self.latency_ms += EWMA_ALPHA * (elapsed_ms - self.latency_ms)
+                self.error_rate += EWMA_ALPHA * ((1.0 if failed else 0.0) - self.error_rate)
+
+    def state(self):
+        with self.lock:
+            return {
+                'enabled': SAMPLING_ENABLED,
+                'rate': self.rate,
+                'sampling': self.sampling,
+                'write_latency_ms': round(self.latency_ms, 2),
+                'write_error_rate': round(self.error_rate, 4),
+                'in_flight': self.in_flight,
+                'kept': self.kept,
+                'dropped': self.dropped,
+                'last_change': self.last_change
+            }
@@ -0,0 +1,232 @@
+"""
+Redis-backed sketches used by the analytics service.
+
+Distinct viewer/session counts are kept as HyperLogLog sketches per paste per
+day (plus a global "all pastes" scope and an all-time sketch per scope), so any
+date range can be answered by merging the daily sketches with PFCOUNT instead
+of running COUNT(DISTINCT ...) over the whole ViewEvent table.
+
+Top pastes are kept in sorted sets that are updated on every view: an all-time
+set, one set per hour for rolling windows, and a forward-decayed "trending"
+set, so rankings are read with ZREVRANGE instead of a GROUP BY over all events.
+"""
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+# Redis HyperLogLogs use 16384 registers, which gives a standard error of
+# 1.04 / sqrt(16384) ~= 0.81% for single sketches and for merged ranges alike.
+HLL_STANDARD_ERROR = 0.0081
+HLL_RETENTION_DAYS = int(os.getenv('HLL_RETENTION_DAYS', '400'))
+
+# Hourly and trending sets are trimmed to the highest TOPK_CAPACITY pastes
+TOPK_CAPACITY = int(os.getenv('TOPK_CAPACITY', '1000'))
+TOPK_TRIM_PROBABILITY = 0.01
+TOPK_BUCKET_RETENTION_HOURS = int(os.getenv('TOPK_BUCKET_RETENTION_HOURS', str(7 * 24)))
+TOPK_WINDOW_CACHE_SECONDS = int(os.getenv('TOPK_WINDOW_CACHE_SECONDS', '10'))
+
+# Trending scores halve every TRENDING_HALF_LIFE seconds. Scores are stored
+# relative to the start of an epoch of TRENDING_EPOCH_HALF_LIVES half-lives so
+# they never overflow; anything older than the previous epoch has decayed by
+# at least 2**-32 and is ignored.
+TRENDING_HALF_LIFE = float(os.getenv('TRENDING_HALF_LIFE', '3600'))
+TRENDING_EPOCH_HALF_LIVES = 32
+
+# paste_metadata.last_seen is written at most once per PASTE_METADATA_REFRESH_SECONDS,
+# so a paste's keys are looked for up to this long after it
+SEEN_MARGIN = timedelta(hours=1)
+
+KEY_PREFIX = 'analytics'
+ALL_PASTES = 'all'
+
+
+def _scope(paste_id):
+    return ALL_PASTES if paste_id is None else str(paste_id)
+
+
+def hll_day_key(kind, day, paste_id=None):
+    """Key of the daily sketch for `kind` ('ip' or 'session')."""
+    return f"{KEY_PREFIX}:hll:{kind}:{_scope(paste_id)}:{day.strftime('%Y%m%d')}"
+
+
+def hll_total_key(kind, paste_id=None):
+    """Key of the all-time sketch for `kind` ('ip' or 'session')."""
+    return f"{KEY_PREFIX}:hll:{kind}:{_scope(paste_id)}:total"
+
+
+def record_distinct(client, paste_id, timestamp, ip_address=None, session_id=None):
+    """Add the viewer IP and session of one event to the paste and global sketches."""
+    day = timestamp.date()
+    ttl = int(timedelta(days=HLL_RETENTION_DAYS).total_seconds())
+
+    pipe = client.pipeline(transaction=False)
+    for kind, value in (('ip', ip_address), ('session', session_id)):
+        if not value:
+            continue
+        for scope in (paste_id, None):
+            day_key = hll_day_key(kind, day, scope)
+            pipe.pfadd(day_key, value)
+            pipe.expire(day_key, ttl)
+            pipe.pfadd(hll_total_key(kind, scope), value)
+    pipe.execute()
+
+
+def count_distinct(client, kind, start=None, end=None, paste_id=None):
+    """
+    Estimate the number of distinct `kind` values between `start` and `end`
+    (inclusive dates). Without a start date the all-time sketch is used.
+    """
+    if start is None:
+        return client.pfcount(hll_total_key(kind, paste_id))
+
+    end = end or datetime.utcnow().date()
+    keys = []
+    day = start
+    while day <= end:
+        keys.append(hll_day_key(kind, day, paste_id))
+        day += timedelta(days=1)
+    if not keys:
+        return 0
+    return client.pfcount(*keys)
+
+
+def _seen_range(first_seen, last_seen, retention, margin):
+    """
+    The span a paste's keys can be bucketed in: first_seen to last_seen plus
+    `margin`, within the last `retention`. Unknown bounds take the whole
+    retention window.
+    """
+    now = datetime.utcnow()
+    start = now - retention if first_seen is None else max(first_seen, now - retention)
+    end = now if last_seen is None else min(last_seen + margin, now)
+    return start, end
+
+
+def delete_paste_sketches(pipe, paste_id, first_seen=None, last_seen=None):
+    """
+    Queue the deletion of every sketch kept for a single paste on `pipe`. The
+    daily keys are derived from the days the paste was seen, so no SCAN of
+    the keyspace is needed.
+    """
+    start, end = _seen_range(first_seen, last_seen, timedelta(days=HLL_RETENTION_DAYS), SEEN_MARGIN)
+    keys = [hll_total_key(kind, paste_id) for kind in ('ip', 'session')]
+    day = start.date()
+    while day <= end.date():
+        keys.extend(hll_day_key(kind, day, paste_id) for kind in ('ip', 'session'))
+        day += timedelta(days=1)
+    pipe.unlink(*keys)
+    return len(keys)
+
+
+def topk_all_key():
+    return f"{KEY_PREFIX}:topk:all"
+
+
+def topk_hour_key(moment):
+    return f"{KEY_PREFIX}:topk:hour:{moment.strftime('%Y%m%d%H')}"
+
+
+def topk_trending_key(epoch):
+    return f"{KEY_PREFIX}:topk:trending:{epoch}"
+
+
+def short_urls_key():
+    return f"{KEY_PREFIX}:topk:short_urls"
+
+
+def _trending_epoch(now):
+    """Return the current trending epoch and its start as a UNIX timestamp."""
+    epoch_length = TRENDING_HALF_LIFE * TRENDING_EPOCH_HALF_LIVES
+    epoch = int(now // epoch_length)
+    return epoch, epoch * epoch_length
+
+
+def record_view(client, paste_id, short_url, timestamp, weight=1):
+    """Count one view of a paste in the all-time, hourly and trending rankings."""
+    now = time.time()
+    epoch, epoch_start = _trending_epoch(now)
+    hour_key = topk_hour_key(timestamp)
+    trending_key = topk_trending_key(epoch)
+
+    pipe = client.pipeline(transaction=False)
+    pipe.hset(short_urls_key(), paste_id, short_url)
+    pipe.zincrby(topk_all_key(), weight, paste_id)
+    pipe.zincrby(hour_key, weight, paste_id)
+    pipe.expire(hour_key, TOPK_BUCKET_RETENTION_HOURS * 3600)
+    pipe.zincrby(trending_key, weight * 2 ** ((now - epoch_start) / TRENDING_HALF_LIFE), paste_id)
+    pipe.expire(trending_key, int(2 * TRENDING_HALF_LIFE * TRENDING_EPOCH_HALF_LIVES))
+    if random.random() < TOPK_TRIM_PROBABILITY:
+        # Keep only the heaviest pastes; the tail can never reach the top-K
+        for key in (hour_key, trending_key):
+            pipe.zremrangebyrank(key, 0, -(TOPK_CAPACITY + 1))
+    pipe.execute()
+
+
+def top_all_time(client, limit):
+    """Highest all-time view counts as (paste_id, views) pairs."""
+    return [(int(member), score)
+            for member, score in client.zrevrange(topk_all_key(), 0, limit - 1, withscores=True)]
+
+
+def top_window(client, hours, limit):
+    """
+    Highest view counts over the last `hours` hourly buckets (the current,
+    partial hour included). The union of the buckets is cached for a few
+    seconds so repeated reads stay O(K).
+    """
+    cache_key = f"{KEY_PREFIX}:topk:window:{hours}"
+    if not client.exists(cache_key):
+        now = datetime.utcnow()
+        keys = [topk_hour_key(now - timedelta(hours=h)) for h in range(hours)]
+        pipe = client.pipeline()
+        pipe.zunionstore(cache_key, keys)
+        pipe.expire(cache_key, TOPK_WINDOW_CACHE_SECONDS)
+        pipe.execute()
+    return [(int(member), score)
+            for member, score in client.zrevrange(cache_key, 0, limit - 1, withscores=True)]
+
+
+def top_trending(client, limit):
+    """
+    Highest exponentially decayed view counts as (paste_id, score) pairs,
+    where a view counts as 1 now and half as much every TRENDING_HALF_LIFE
+    seconds afterwards.
+    """
+    now = time.time()
+    epoch, epoch_start = _trending_epoch(now)
+    previous_start = epoch_start - TRENDING_HALF_LIFE * TRENDING_EPOCH_HALF_LIVES
+
+    scores = {}
+    for key, start in ((topk_trending_key(epoch), epoch_start),
+                       (topk_trending_key(epoch - 1), previous_start)):
+        decay = 2 ** (-(now - start) / TRENDING_HALF_LIFE)
+        for member, score in client.zrevrange(key, 0, 2 * limit - 1, withscores=True):
+            scores[int(member)] = scores.get(int(member), 0.0) + score * decay
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+
+def lookup_short_urls(client, paste_ids):
+    """Map paste ids to the short URLs recorded alongside their views."""
+    if not paste_ids:
+        return {}
+    return dict(zip(paste_ids, client.hmget(short_urls_key(), paste_ids)))
+
+
+def delete_paste_rankings(pipe, paste_id, first_seen=None, last_seen=None):
+    """
+    Queue the removal of a paste from every ranking it can appear in on
+    `pipe`: the all-time set, the hourly sets of the hours it was seen and
+    the current and previous trending epochs.
+    """
+    start, end = _seen_range(first_seen, last_seen, timedelta(hours=TOPK_BUCKET_RETENTION_HOURS), SEEN_MARGIN)
+    epoch, _ = _trending_epoch(time.time())
+    keys = [topk_all_key(), topk_trending_key(epoch), topk_trending_key(epoch - 1)]
+    hour = start.replace(minute=0, second=0, microsecond=0)
+    while hour <= end:
+        keys.append(topk_hour_key(hour))
+        hour += timedelta(hours=1)
+    for key in keys:
+        pipe.zrem(key, paste_id)
+    pipe.hdel(short_urls_key(), paste_id)
+    return len(keys)
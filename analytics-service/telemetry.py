@@ -0,0 +1,194 @@
+"""
+In-process ingestion telemetry for the /system page.
+
+Each ingested event records its processing latency (in microseconds) and
+whether it failed. The figures go into two ring buffers of time slots: one
+slot per minute for the last TELEMETRY_MINUTES minutes, and one slot per hour
+for the last TELEMETRY_HOURS hours. A slot holds event and error counts,
+errors by type, and an HDR-style latency histogram. Slots are reused as time
+moves on, so memory stays fixed and reading the figures never touches the
+database.
+
+The buffers are per process. With several workers, each one reports its own
+share of the traffic.
+"""
+import os
+import threading
+import time
+from datetime import datetime
+
+TELEMETRY_MINUTES = int(os.getenv('TELEMETRY_MINUTES', '60'))
+TELEMETRY_HOURS = int(os.getenv('TELEMETRY_HOURS', '24'))
+
+# 2^7 sub-buckets per power of two: values are kept to within 1/64 (~1.6%)
+SUB_BUCKET_BITS = 7
+MAX_LATENCY_US = 3600 * 1000000
+
+
+class LatencyHistogram:
+    """
+    Log-linear histogram of integer microsecond values, in the style of
+    HdrHistogram. Values below 2^SUB_BUCKET_BITS are exact. Larger values keep
+    their top SUB_BUCKET_BITS bits.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @staticmethod
+    def _bucket(value):
+        shift = max(0, value.bit_length() - SUB_BUCKET_BITS)
+        return shift, value >> shift
+
+    @staticmethod
+    def _bucket_value(bucket):
+        shift, sub = bucket
+        # Middle of the range of values sharing this bucket
+        return (sub << shift) + ((1 << shift) >> 1)
+
+    def record(self, value):
+        value = min(max(int(value), 0), MAX_LATENCY_US)
+        bucket = self._bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        return self
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """Value at percentile p (0-100), or 0 for an empty histogram."""
+        if not self.count:
+            return 0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self._bucket_value(bucket), self.max)
+        return self.max
+
+
+class _Slot:
+    __slots__ = ('start', 'events', 'errors', 'error_types', 'latency')
+
+    def __init__(self, start):
+        self.start = start
+        self.events = 0
+        self.errors = 0
+        self.error_types = {}
+        self.latency = LatencyHistogram()
+
+
+class RingBuffer:
+    """Fixed number of consecutive time slots of `width` seconds each."""
+
+    def __init__(self, size, width):
+        self.size = size
+        self.width = width
+        self.slots = [None] * size
+
+    def slot(self, now):
+        start = int(now // self.width) * self.width
+        index = (start // self.width) % self.size
+        slot = self.slots[index]
+        if slot is None or slot.start != start:
+            slot = self.slots[index] = _Slot(start)
+        return slot
+
+    def window(self, now):
+        """All slots of the last `size` periods, oldest first; missing periods are empty."""
+        current = int(now // self.width) * self.width
+        result = []
+        for i in range(self.size - 1, -1, -1):
+            start = current - i * self.width
+            slot = self.slots[(start // self.width) % self.size]
+            result.append(slot if slot is not None and slot.start == start else _Slot(start))
+        return result
+
+
+class IngestTelemetry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.minutes = RingBuffer(TELEMETRY_MINUTES, 60)
+        self.hours = RingBuffer(TELEMETRY_HOURS, 3600)
+        self.started = time.time()
+
+    def record(self, latency_seconds, error_type=None):
+        """Record one ingested event; error_type marks it as failed."""
+        now = time.time()
+        latency_us = latency_seconds * 1000000
+        with self.lock:
+            for ring in (self.minutes, self.hours):
+                slot = ring.slot(now)
+                slot.events += 1
+                slot.latency.record(latency_us)
+                if error_type:
+                    slot.errors += 1
+                    slot.error_types[error_type] = slot.error_types.get(error_type, 0) + 1
+
+    def current(self, now=None):
+        """Rate, error rate and latency over the last full minute plus the current one."""
+        now = now or time.time()
+        with self.lock:
+            slots = self.minutes.window(now)[-2:]
+            latency = LatencyHistogram()
+            for slot in slots:
+                latency.merge(slot.latency)
+            events = sum(slot.events for slot in slots)
+            errors = sum(slot.errors for slot in slots)
+        elapsed = max(1.0, min(now - slots[0].start, now - self.started))
+        return {
+            'ingestion_rate': round(events / elapsed, 2),
+            'error_rate': round(100.0 * errors / events, 2) if events else 0.0,
+            'avg_latency_ms': round(latency.mean() / 1000, 2),
+            'p50_latency_ms': round(latency.percentile(50) / 1000, 2),
+            'p90_latency_ms': round(latency.percentile(90) / 1000, 2),
+            'p99_latency_ms': round(latency.percentile(99) / 1000, 2),
+            'max_latency_ms': round(latency.max / 1000, 2)
+        }
+
+    def series(self, ring, label_format, now=None):
+        """Per-slot counts and latencies of a ring buffer, oldest first."""
+        now = now or time.time()
+        with self.lock:
+            return [{
+                'start': datetime.utcfromtimestamp(slot.start).isoformat(),
+                'label': datetime.utcfromtimestamp(slot.start).strftime(label_format),
+                'events': slot.events,
+                'errors': slot.errors,
+                'avg_latency_ms': round(slot.latency.mean() / 1000, 2),
+                'p99_latency_ms': round(slot.latency.percentile(99) / 1000, 2)
+            } for slot in ring.window(now)]
+
+    def error_types(self, now=None):
+        """Errors by type over the hour ring buffer."""
+        now = now or time.time()
+        totals = {}
+        with self.lock:
+            for slot in self.hours.window(now):
+                for error_type, count in slot.error_types.items():
+                    totals[error_type] = totals.get(error_type, 0) + count
+        return totals
+
+    def snapshot(self):
+        now = time.time()
+        return {
+            'current': self.current(now),
+            'minutes': self.series(self.minutes, '%H:%M', now),
+            'hours': self.series(self.hours, '%H:00', now),
+            'error_types': self.error_types(now),
+            'uptime_seconds': round(now - self.started, 1)
+        }
@@ -0,0 +1,64 @@
+import ipaddress
+import uuid
+
+import pytest
+
+import encoding
+
+
+@pytest.mark.parametrize('address', ['203.0.113.7', '0.0.0.0', '2001:db8::1', '::ffff:192.0.2.1'])
+def test_ip_round_trip(address):
+    packed = encoding.encode_ip(address)
+
+    assert len(packed) == (4 if '.' in address and ':' not in address else 16)
+    # Compared as addresses: Python versions differ in how they print IPv4-mapped ones
+    assert ipaddress.ip_address(encoding.decode_ip(packed)) == ipaddress.ip_address(address)
+
+
+def test_ip_decodes_stored_bytearray():
+    # MySQL connectors return VARBINARY columns as bytearray
+    assert encoding.decode_ip(bytearray(encoding.encode_ip('198.51.100.1'))) == '198.51.100.1'
+
+
+@pytest.mark.parametrize('value', [None, '', 'not an ip', '300.1.1.1'])
+def test_invalid_ip_is_dropped(value):
+    assert encoding.encode_ip(value) is None
+
+
+def test_uuid_round_trip():
+    value = str(uuid.uuid4())
+
+    assert encoding.decode_uuid(encoding.encode_uuid(value)) == value
+    assert encoding.decode_uuid(encoding.encode_uuid(value.upper())) == value
+
+
+def test_non_uuid_ids_stay_distinct():
+    first = encoding.encode_uuid('session-1')
+
+    assert len(first) == 16
+    assert first == encoding.encode_uuid('session-1')
+    assert first != encoding.encode_uuid('session-2')
+
+
+def test_empty_values_decode_to_none():
+    assert encoding.encode_uuid('') is None
+    assert encoding.decode_uuid(None) is None
+    assert encoding.decode_ip(b'') is None
+
+
+def test_clip():
+    assert encoding.clip('') is None
+    assert encoding.clip('x' * 300) == 'x' * encoding.MAX_STRING_LENGTH
+
+
+@pytest.mark.parametrize('referrer, domain', [
+    ('https://www.Google.com:443/search?q=x', 'google.com'),
+    ('http://news.ycombinator.com/', 'news.ycombinator.com'),
+    ('t.co/abc', 't.co'),
+    ('https://example.org./', 'example.org'),
+    ('', None),
+    ('not a url', None),
+    ('http://[::1', None),
+])
+def test_referrer_domain(referrer, domain):
+    assert encoding.referrer_domain(referrer) == domain
@@ -0,0 +1,91 @@
+import csv
+import io
+import json
+
+import pytest
+
+import export
+
+FILTERS = {'start': '2024-03-01T00:00:00', 'end': '2024-03-08T00:00:00', 'paste_id': 42}
+
+
+def make_rows(count):
+    return [{'id': i * 3, 'paste_id': 42} for i in range(1, count + 1)]
+
+
+def pager(rows, fail_after=None):
+    """fetch_page over `rows`; raises once asked for a page after id `fail_after`."""
+    def fetch_page(after, size):
+        if fail_after is not None and after >= fail_after:
+            raise RuntimeError("connection lost")
+        return [row for row in rows if row['id'] > after][:size]
+    return fetch_page
+
+
+def to_record(row):
+    return {column: row.get(column) for column in export.COLUMNS if column != 'cursor'}
+
+
+def ndjson_records(chunks):
+    return [json.loads(line) for line in ''.join(chunks).splitlines()]
+
+
+def test_cursor_round_trip():
+    token = export.encode_cursor(FILTERS, 12345)
+
+    assert '=' not in token
+    assert export.decode_cursor(token) == (FILTERS, 12345)
+
+
+@pytest.mark.parametrize('token', [
+    '',
+    'not a cursor',
+    'W10',  # []
+    'eyJhIjoxfQ',  # {"a":1}
+    export.encode_cursor({}, 'x'),
+])
+def test_invalid_cursor(token):
+    with pytest.raises(ValueError):
+        export.decode_cursor(token)
+
+
+def test_resume_from_any_record_cursor(monkeypatch):
+    monkeypatch.setattr(export, 'EXPORT_PAGE_SIZE', 4)
+    rows = make_rows(10)
+    records = ndjson_records(export.stream(pager(rows), to_record, FILTERS, 0, 'ndjson'))
+    assert [record['id'] for record in records] == [row['id'] for row in rows]
+
+    filters, after = export.decode_cursor(records[5]['cursor'])
+    assert filters == FILTERS
+    resumed = ndjson_records(export.stream(pager(rows), to_record, filters, after, 'ndjson'))
+    assert [record['id'] for record in resumed] == [row['id'] for row in rows[6:]]
+
+
+def test_limit(monkeypatch):
+    monkeypatch.setattr(export, 'EXPORT_PAGE_SIZE', 4)
+    records = ndjson_records(export.stream(pager(make_rows(10)), to_record, FILTERS, 0, 'ndjson', limit=6))
+
+    assert len(records) == 6
+
+
+@pytest.mark.parametrize('fmt', ['ndjson', 'csv'])
+def test_failed_page_ends_with_resumable_error(monkeypatch, fmt):
+    monkeypatch.setattr(export, 'EXPORT_PAGE_SIZE', 4)
+    rows = make_rows(10)
+    body = ''.join(export.stream(pager(rows, fail_after=rows[3]['id']), to_record, FILTERS, 0, fmt))
+
+    assert export.ends_with_error(body, fmt)
+    if fmt == 'csv':
+        last = list(csv.reader(io.StringIO(body)))[-1]
+        assert last[0] == export.CSV_ERROR_MARKER
+        cursor = last[2]
+    else:
+        cursor = json.loads(body.splitlines()[-1])['cursor']
+    assert export.decode_cursor(cursor) == (FILTERS, rows[3]['id'])
+
+
+@pytest.mark.parametrize('fmt', ['ndjson', 'csv'])
+def test_complete_export_has_no_error_record(fmt):
+    body = ''.join(export.stream(pager(make_rows(3)), to_record, FILTERS, 0, fmt))
+
+    assert not export.ends_with_error(body, fmt)
@@ -0,0 +1,79 @@
+import math
+import random
+
+import pytest
+
+from quantiles import LogBucketSketch
+
+QS = (0.0, 0.1, 0.5, 0.9, 0.99, 1.0)
+
+
+def exact_quantile(values, q):
+    # The sketch returns the bucket of the value at rank floor(q * (n - 1))
+    return sorted(values)[math.floor(q * (len(values) - 1))]
+
+
+def assert_within_accuracy(sketch, values):
+    for q in QS:
+        exact = exact_quantile(values, q)
+        estimate = sketch.quantile(q)
+        assert abs(estimate - exact) <= sketch.relative_accuracy * exact * (1 + 1e-9), (q, estimate, exact)
+
+
+@pytest.mark.parametrize('relative_accuracy', [0.01, 0.05])
+def test_quantiles_within_relative_accuracy(relative_accuracy):
+    rng = random.Random(7)
+    values = [rng.lognormvariate(3, 2) for _ in range(20000)]
+    sketch = LogBucketSketch(relative_accuracy)
+    for value in values:
+        sketch.add(value)
+
+    assert sketch.count == len(values)
+    assert_within_accuracy(sketch, values)
+
+
+def test_merge_matches_single_sketch():
+    rng = random.Random(11)
+    values = [rng.expovariate(0.01) for _ in range(5000)]
+    merged = LogBucketSketch(0.01)
+    single = LogBucketSketch(0.01)
+    for chunk in (values[:1000], values[1000:4000], values[4000:]):
+        part = LogBucketSketch(0.01)
+        for value in chunk:
+            part.add(value)
+            single.add(value)
+        merged.merge(part)
+
+    assert merged.buckets == single.buckets
+    assert merged.quantiles() == single.quantiles()
+    assert_within_accuracy(merged, values)
+
+
+def test_merge_rejects_other_accuracy():
+    with pytest.raises(ValueError):
+        LogBucketSketch(0.01).merge(LogBucketSketch(0.02))
+
+
+def test_buckets_from_the_database():
+    sketch = LogBucketSketch(0.01)
+    direct = LogBucketSketch(0.01)
+    for value, count in ((12.5, 3), (400.0, 1), (0, 2)):
+        sketch.add_bucket(sketch.bucket_index(value), count)
+        direct.add(value, count)
+
+    # Databases return the bucket index as a Decimal or float
+    sketch.add_bucket(float(sketch.bucket_index(12.5)), 1)
+    direct.add(12.5)
+    assert sketch.buckets == direct.buckets
+    assert sketch.zero_count == 2
+
+
+def test_zero_values_and_empty_sketch():
+    sketch = LogBucketSketch(0.01)
+    assert sketch.quantile(0.5) is None
+    assert sketch.quantiles() == {'p50': None, 'p90': None, 'p99': None}
+
+    for value in (0, 0, 0, 10):
+        sketch.add(value)
+    assert sketch.quantile(0.5) == 0.0
+    assert sketch.quantile(1.0) == pytest.approx(10, rel=0.01)
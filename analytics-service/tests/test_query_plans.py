@@ -0,0 +1,47 @@
+"""
+Query plans of the stats endpoints (see explain_queries.py).
+
+Needs a scratch MySQL database in TEST_DATABASE_URL, which the fixture fills
+with synthetic events, and the Redis of REDIS_HOST/REDIS_PORT; skipped
+otherwise. Never point it at production.
+"""
+import os
+
+import pytest
+
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL')
+SEED_EVENTS = int(os.getenv('TEST_SEED_EVENTS', '50000'))
+MIN_ROWS = 1000
+
+pytestmark = pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL is not set")
+
+
+@pytest.fixture(scope='module')
+def plans():
+    # app reads DATABASE_URL when it is imported
+    os.environ['DATABASE_URL'] = TEST_DATABASE_URL
+    import explain_queries
+    from app import app, db
+
+    with app.app_context():
+        db.create_all()
+        explain_queries.migrations.run_migrations(db.engine)
+        explain_queries.seed(SEED_EVENTS)
+        yield explain_queries.check_plans(MIN_ROWS)
+
+
+def test_seeded_tables_are_large_enough(plans):
+    sizes, _, _ = plans
+    assert sizes['view_event'] >= MIN_ROWS
+
+
+def test_endpoints_succeed(plans):
+    _, _, errors = plans
+    assert errors == []
+
+
+def test_no_full_table_scans(plans):
+    _, statements, _ = plans
+    scans = [f"{path}: {', '.join(scanned)} in {' '.join(statement.split())}"
+             for path, statement, _, scanned in statements if scanned]
+    assert scans == []
@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta
+
+import sketches
+
+DAY = datetime(2024, 3, 10, 12, 0)
+
+
+def record_days(client, paste_id, days, viewers_per_day, overlap):
+    """Record `viewers_per_day` IPs a day, `overlap` of them seen every day."""
+    for day in range(days):
+        for viewer in range(viewers_per_day):
+            ip = f"10.0.{viewer}.1" if viewer < overlap else f"10.{day + 1}.{viewer}.1"
+            sketches.record_distinct(client, paste_id, DAY + timedelta(days=day), ip_address=ip,
+                                     session_id=f"{paste_id}-{day}-{viewer}")
+
+
+def within_error(estimate, exact):
+    # fakeredis counts HyperLogLogs exactly; Redis stays within a few standard errors
+    return abs(estimate - exact) <= 3 * sketches.HLL_STANDARD_ERROR * exact
+
+
+def test_range_merges_daily_sketches(redis_client):
+    record_days(redis_client, 1, days=3, viewers_per_day=200, overlap=50)
+
+    first = DAY.date()
+    assert within_error(sketches.count_distinct(redis_client, 'ip', first, first, paste_id=1), 200)
+    assert within_error(sketches.count_distinct(redis_client, 'ip', first, first + timedelta(days=2), paste_id=1),
+                        50 + 3 * 150)
+    assert within_error(sketches.count_distinct(redis_client, 'session', first, first + timedelta(days=2),
+                                                paste_id=1), 3 * 200)
+
+
+def test_all_time_and_global_scopes(redis_client):
+    record_days(redis_client, 1, days=2, viewers_per_day=100, overlap=100)
+    record_days(redis_client, 2, days=1, viewers_per_day=300, overlap=0)
+
+    assert within_error(sketches.count_distinct(redis_client, 'ip', paste_id=1), 100)
+    assert within_error(sketches.count_distinct(redis_client, 'ip', paste_id=2), 300)
+    # Paste 1 only saw 10.0.x.1 and paste 2 only 10.1.x.1
+    assert within_error(sketches.count_distinct(redis_client, 'ip'), 100 + 300)
+
+
+def test_range_without_days_is_empty(redis_client):
+    record_days(redis_client, 1, days=1, viewers_per_day=10, overlap=0)
+
+    first = DAY.date()
+    assert sketches.count_distinct(redis_client, 'ip', first, first - timedelta(days=1), paste_id=1) == 0
+    assert sketches.count_distinct(redis_client, 'ip', first + timedelta(days=5), first + timedelta(days=6),
+                                   paste_id=1) == 0
+
+
+def test_events_without_ip_or_session_are_skipped(redis_client):
+    sketches.record_distinct(redis_client, 1, DAY, ip_address=None, session_id=None)
+
+    assert redis_client.keys('*') == []
+
+
+def test_delete_paste_sketches_keeps_other_pastes(redis_client):
+    now = datetime.utcnow()
+    for paste_id in (1, 2):
+        for day in range(3):
+            sketches.record_distinct(redis_client, paste_id, now - timedelta(days=day),
+                                     ip_address=f"10.0.{day}.1", session_id=f"s{paste_id}-{day}")
+
+    pipe = redis_client.pipeline()
+    sketches.delete_paste_sketches(pipe, 1, first_seen=now - timedelta(days=2), last_seen=now)
+    pipe.execute()
+
+    remaining = redis_client.keys('*')
+    assert not [key for key in remaining if key.split(':')[3] == '1']
+    assert sketches.count_distinct(redis_client, 'ip', paste_id=2) == 3
+    assert sketches.count_distinct(redis_client, 'ip') == 3
@@ -0,0 +1,60 @@
+"""
+User agent classification for the analytics service.
+
+Events are classified once at ingest and stored as small-integer `browser`
+and `device` columns, so the stats endpoints can GROUP BY integers instead of
+re-parsing every distinct user agent string on each request. The ids are
+positions in BROWSERS/DEVICES and are persisted, so only ever append to them.
+"""
+import os
+from functools import lru_cache
+
+BROWSERS = ('Chrome', 'Firefox', 'Safari', 'Edge', 'IE', 'Opera', 'Other')
+DEVICES = ('Mobile', 'Tablet', 'Desktop', 'Bot', 'Other')
+
+UA_CACHE_SIZE = int(os.getenv('UA_CACHE_SIZE', '4096'))
+
+
+def _detect_browser(ua):
+    if 'chrome' in ua and 'edge' not in ua and 'opr' not in ua:
+        return 'Chrome'
+    elif 'firefox' in ua:
+        return 'Firefox'
+    elif 'safari' in ua and 'chrome' not in ua:
+        return 'Safari'
+    elif 'edge' in ua:
+        return 'Edge'
+    elif 'msie' in ua or 'trident' in ua:
+        return 'IE'
+    elif 'opr' in ua or 'opera' in ua:
+        return 'Opera'
+    return 'Other'
+
+
+def _detect_device(ua):
+    if 'mobile' in ua or 'android' in ua:
+        return 'Mobile'
+    elif 'ipad' in ua or 'tablet' in ua:
+        return 'Tablet'
+    elif 'bot' in ua or 'crawl' in ua or 'spider' in ua:
+        return 'Bot'
+    elif ('windows' in ua or 'macintosh' in ua or 'linux' in ua) and 'mobile' not in ua:
+        return 'Desktop'
+    return 'Other'
+
+
+@lru_cache(maxsize=UA_CACHE_SIZE)
+def classify(user_agent):
+    """Return (browser_id, device_id) for a user agent string, or (None, None) without one."""
+    if not user_agent:
+        return None, None
+    ua = user_agent.lower()
+    return BROWSERS.index(_detect_browser(ua)), DEVICES.index(_detect_device(ua))
+
+
+def browser_name(browser_id):
+    return BROWSERS[browser_id] if browser_id is not None and 0 <= browser_id < len(BROWSERS) else 'Other'
+
+
+def device_name(device_id):
+    return DEVICES[device_id] if device_id is not None and 0 <= device_id < len(DEVICES) else 'Other'
@@ -1,11 +1,17 @@
 import os
 import requests
+import redis
 import logging
+import threading
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
 
+import leases
+
 # Load environment variables
 load_dotenv()
 
@@ -21,9 +27,73 @@ REQUEST_TIMEOUT = int(os.getenv('REQUEST_TIMEOUT', '5'))
 CLEANUP_INTERVAL = int(os.getenv('CLEANUP_INTERVAL', '3600'))
 RETRY_ATTEMPTS = int(os.getenv('RETRY_ATTEMPTS', '3'))
 RETRY_DELAY = float(os.getenv('RETRY_DELAY', '1'))
-PASTE_SERVICE_URL = os.getenv('PASTE_SERVICE_URL', 'http://paste-service:5000')
+# Expired pastes per page (?limit=); a page's deletes are in flight at once
+CLEANUP_BATCH_SIZE = int(os.getenv('CLEANUP_BATCH_SIZE', '5000'))
+# Each run rescans this much before the watermark, for pastes stored after they expired
+CLEANUP_WATERMARK_OVERLAP = int(os.getenv('CLEANUP_WATERMARK_OVERLAP', '3600'))
+# Paste ids per POST /api/pastes/delete request
+BULK_DELETE_SIZE = int(os.getenv('BULK_DELETE_SIZE', '500'))
 VIEW_SERVICE_URL = os.getenv('VIEW_SERVICE_URL', 'http://view-service:5002')
 ANALYTIC_SERVICE_URL = os.getenv('ANALYTIC_SERVICE_URL', 'http://analytic-service:5003')
+# Concurrent bulk deletes (and keep-alive connections) per target service
+VIEW_SERVICE_CONCURRENCY = int(os.getenv('VIEW_SERVICE_CONCURRENCY', '8'))
+ANALYTIC_SERVICE_CONCURRENCY = int(os.getenv('ANALYTIC_SERVICE_CONCURRENCY', '4'))
+REDIS_HOST = os.getenv('REDIS_HOST', 'redis')
+REDIS_PORT = int(os.getenv('REDIS_PORT', '6379'))
+# Sweep partitions (paste_id mod N), each swept by the replica holding its lease
+CLEANUP_PARTITIONS = int(os.getenv('CLEANUP_PARTITIONS', '8'))
+CLEANUP_LEASE_TTL = int(os.getenv('CLEANUP_LEASE_TTL', '30'))
+WATERMARK_KEY = 'cleanup:watermark:{}:{}'
+# Sorted set of paste_id -> expires_at (UNIX seconds), filled by paste-service at create time
+EXPIRY_SCHEDULE_KEY = 'paste_expiry'
+EXPIRY_SCHEDULER_ENABLED = os.getenv('EXPIRY_SCHEDULER_ENABLED', 'true').lower() == 'true'
+EXPIRY_POLL_INTERVAL = float(os.getenv('EXPIRY_POLL_INTERVAL', '1'))
+EXPIRY_BATCH_SIZE = int(os.getenv('EXPIRY_BATCH_SIZE', '100'))
+EXPIRY_RETRY_DELAY = int(os.getenv('EXPIRY_RETRY_DELAY', '60'))
+# Anti-entropy: compare paste id digests between services and report on Redis
+RECONCILE_ENABLED = os.getenv('RECONCILE_ENABLED', 'true').lower() == 'true'
+RECONCILE_INTERVAL = int(os.getenv('RECONCILE_INTERVAL', '21600'))
+RECONCILE_FANOUT = int(os.getenv('RECONCILE_FANOUT', '16'))
+RECONCILE_LEAF_SIZE = int(os.getenv('RECONCILE_LEAF_SIZE', '1000'))
+# Set NX for one interval by the replica that runs the reconciliation
+RECONCILE_CLAIM_KEY = 'cleanup:reconcile'
+
+redis_client = redis.Redis(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    decode_responses=True,
+    db=0,
+    socket_timeout=REQUEST_TIMEOUT,
+    socket_connect_timeout=REQUEST_TIMEOUT
+)
+partition_leases = leases.PartitionLeases(redis_client, CLEANUP_PARTITIONS, CLEANUP_LEASE_TTL)
+
+
+class ServiceClient:
+    """
+    HTTP client for one target service: a keep-alive Session whose pool
+    holds `concurrency` connections, and a thread pool of the same size that
+    runs its bulk deletes. A slow service only backs up its own pool.
+    """
+
+    def __init__(self, key, name, url, concurrency):
+        self.key = key
+        self.name = name
+        self.url = url
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"delete-{name}")
+
+    def submit_delete(self, paste_ids):
+        return self.executor.submit(delete_from_service, self, paste_ids)
+
+
+SERVICES = [
+    ServiceClient('view', "View Service", VIEW_SERVICE_URL, VIEW_SERVICE_CONCURRENCY),
+    ServiceClient('analytics', "Analytic Service", ANALYTIC_SERVICE_URL, ANALYTIC_SERVICE_CONCURRENCY),
+]
 
 # Helper functions with retry mechanism
 @retry(
@@ -32,18 +102,24 @@ ANALYTIC_SERVICE_URL = os.getenv('ANALYTIC_SERVICE_URL', 'http://analytic-servic
     retry=retry_if_exception_type((requests.RequestException, requests.HTTPError)),
     reraise=True
 )
-def get_expired_pastes_from_service(service_url, service_name):
+def get_expired_pastes_from_service(service, partition, after=None):
+    """One page of a partition's expired pastes after the `after` cursor, and the next page's cursor (None at the end)."""
     try:
-        response = requests.get(
-            f"{service_url}/api/pastes/expired",
+        params = {'limit': CLEANUP_BATCH_SIZE, 'partition': partition, 'partitions': CLEANUP_PARTITIONS}
+        if after:
+            params['after'] = after
+        response = service.session.get(
+            f"{service.url}/api/pastes/expired",
+            params=params,
             timeout=REQUEST_TIMEOUT
         )
         response.raise_for_status()
-        pastes = response.json().get('data', [])
-        logger.info(f"Retrieved {len(pastes)} expired pastes from {service_name}")
-        return pastes
+        body = response.json()
+        pastes = body.get('data', [])
+        logger.info(f"Retrieved {len(pastes)} expired pastes from {service.name}")
+        return pastes, body.get('next')
     except Exception as e:
-        logger.error(f"Failed to retrieve expired pastes from {service_name}: {str(e)}")
+        logger.error(f"Failed to retrieve expired pastes from {service.name}: {str(e)}")
         raise
 
 @retry(
@@ -52,105 +128,250 @@ def get_expired_pastes_from_service(service_url, service_name):
     retry=retry_if_exception_type((requests.RequestException, requests.HTTPError)),
     reraise=True
 )
-
-
-@retry(
-    stop=stop_after_attempt(RETRY_ATTEMPTS),
-    wait=wait_fixed(RETRY_DELAY),
-    retry=retry_if_exception_type((requests.RequestException, requests.HTTPError)),
-    reraise=True
-)
-def delete_from_view_service(paste_id):
-    response = requests.delete(
-        f"{VIEW_SERVICE_URL}/api/paste/{paste_id}",
+def delete_from_service(service, paste_ids):
+    response = service.session.post(
+        f"{service.url}/api/pastes/delete",
+        json={"paste_ids": paste_ids},
         timeout=REQUEST_TIMEOUT
     )
     response.raise_for_status()
-    logger.info(f"Successfully deleted paste {paste_id} from View Service")
+    data = response.json().get('data', {})
+    # not_found: already gone from this service (e.g. a previous run got that far)
+    logger.debug(f"Deleted {len(paste_ids) - len(data.get('not_found', []))} pastes from {service.name}")
+
+def delete_pastes(paste_ids):
+    """Delete the pastes from every service in concurrent bulk requests; returns the number deleted everywhere."""
+    chunks = [paste_ids[start:start + BULK_DELETE_SIZE] for start in range(0, len(paste_ids), BULK_DELETE_SIZE)]
+    futures = [(chunk, [(service, service.submit_delete(chunk)) for service in SERVICES]) for chunk in chunks]
+    cleaned = 0
+    for chunk, deletes in futures:
+        success = True
+        for service, future in deletes:
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Failed to delete {len(chunk)} pastes (from {chunk[0]}) from {service.name}: {str(e)}")
+                success = False
+        if success:
+            cleaned += len(chunk)
+        else:
+            logger.warning(f"Partial failure in cleaning up {len(chunk)} pastes (from {chunk[0]})")
+    return cleaned
+
+# Watermark: cursor of the last expired paste deleted everywhere, per source service and partition
+def load_watermark(service, partition):
+    """The cursor to resume from, CLEANUP_WATERMARK_OVERLAP before the saved one; None for a full scan."""
+    try:
+        cursor = redis_client.get(WATERMARK_KEY.format(service.key, partition))
+    except redis.RedisError as e:
+        logger.warning(f"Failed to load the {service.name} watermark, scanning from the start: {str(e)}")
+        return None
+    if not cursor:
+        return None
+    try:
+        expires_at = datetime.fromisoformat(cursor.rsplit(',', 1)[0])
+    except ValueError:
+        logger.warning(f"Ignoring invalid {service.name} watermark '{cursor}'")
+        return None
+    return f"{(expires_at - timedelta(seconds=CLEANUP_WATERMARK_OVERLAP)).isoformat()},0"
 
+def save_watermark(service, partition, paste):
+    try:
+        redis_client.set(WATERMARK_KEY.format(service.key, partition), f"{paste['expires_at']},{paste['paste_id']}")
+    except redis.RedisError as e:
+        logger.warning(f"Failed to save the {service.name} watermark: {str(e)}")
+
+def cleanup_from_service(service, partition):
+    """
+    Delete the pastes of `partition` that expired since its watermark on
+    `service`, a page at a time, moving the watermark past each page deleted
+    everywhere. A page with failures stops the scan, so the next run retries
+    it; so does losing the partition's lease.
+    """
+    after = load_watermark(service, partition)
+    found = cleaned = 0
+    while True:
+        pastes, after = get_expired_pastes_from_service(service, partition, after)
+        paste_ids = list(dict.fromkeys(paste['paste_id'] for paste in pastes if paste.get('paste_id')))
+        if not partition_leases.owns(partition):
+            logger.warning(f"Stopping the {service.name} scan of partition {partition}: lease lost")
+            break
+        if paste_ids:
+            found += len(paste_ids)
+            deleted = delete_pastes(paste_ids)
+            cleaned += deleted
+            if deleted < len(paste_ids):
+                logger.warning(f"Stopping the {service.name} scan at a partially failed page")
+                break
+            save_watermark(service, partition, pastes[-1])
+        if not after:
+            break
+    return found, cleaned
+
+# Expiry schedule: delete pastes as they expire, between the periodic sweeps
+def claim_due_pastes(now):
+    """
+    Take up to EXPIRY_BATCH_SIZE pastes due by `now` off the schedule. A
+    paste belongs to the worker whose ZREM removed it, so several cleanup
+    instances never delete the same paste twice.
+    """
+    due = redis_client.zrangebyscore(EXPIRY_SCHEDULE_KEY, '-inf', now, start=0, num=EXPIRY_BATCH_SIZE)
+    if not due:
+        return []
+    pipe = redis_client.pipeline(transaction=False)
+    for member in due:
+        pipe.zrem(EXPIRY_SCHEDULE_KEY, member)
+    return [int(member) for member, removed in zip(due, pipe.execute()) if removed]
+
+def run_expiry_scheduler():
+    """
+    Pop due pastes and bulk-delete them, draining a backlog batch by batch
+    and polling every EXPIRY_POLL_INTERVAL seconds once it is empty. A
+    failed batch goes back on the schedule EXPIRY_RETRY_DELAY seconds later.
+    Claimed pastes lost to a crash are left to the periodic sweep.
+    """
+    while True:
+        claimed = []
+        try:
+            claimed = claim_due_pastes(time.time())
+            if claimed:
+                deleted = delete_pastes(claimed)
+                if deleted < len(claimed):
+                    retry_at = time.time() + EXPIRY_RETRY_DELAY
+                    redis_client.zadd(EXPIRY_SCHEDULE_KEY, {paste_id: retry_at for paste_id in claimed})
+                else:
+                    logger.info(f"Deleted {deleted} pastes as they expired")
+                continue
+        except Exception as e:
+            logger.error(f"Expiry scheduler failed{f' with {len(claimed)} claimed pastes' if claimed else ''}: {str(e)}")
+        time.sleep(EXPIRY_POLL_INTERVAL)
+
+# Anti-entropy: analytics holds the pastes view-service has reported to it, and no others
 @retry(
     stop=stop_after_attempt(RETRY_ATTEMPTS),
     wait=wait_fixed(RETRY_DELAY),
     retry=retry_if_exception_type((requests.RequestException, requests.HTTPError)),
     reraise=True
 )
-def delete_from_analytic_service(paste_id):
-    response = requests.delete(
-        f"{ANALYTIC_SERVICE_URL}/api/paste/{paste_id}",
-        timeout=REQUEST_TIMEOUT
-    )
+def call_service(service, method, path, params=None, json=None):
+    response = service.session.request(method, f"{service.url}{path}", params=params, json=json,
+                                       timeout=REQUEST_TIMEOUT)
     response.raise_for_status()
-    logger.info(f"Successfully deleted paste {paste_id} from Analytic Service")
+    return response.json()
 
-# Cleanup logic
-def cleanup_expired_pastes():
+def find_mismatches(view, analytics, start, end):
+    """
+    Compare the paste ids of [start, end) on both services and return
+    (orphans, unregistered): the ids analytics holds that view-service no
+    longer has, and the pastes view-service reported as viewed that
+    analytics lacks. The view-service digests cover the reported pastes, so
+    in steady state the digests of a range match and it is skipped.
+    Differing ranges are split RECONCILE_FANOUT ways until neither side holds
+    more than RECONCILE_LEAF_SIZE pastes in them, then their ids are listed
+    on both sides. An id only analytics lists is an orphan once view-service
+    confirms it has no such paste: one viewed since the last sync of its
+    view_count is not in the digests yet.
+    """
+    params = {'start': start, 'end': end, 'buckets': RECONCILE_FANOUT}
+    view_buckets = call_service(view, 'GET', '/api/pastes/digest', params)['data']
+    analytic_buckets = call_service(analytics, 'GET', '/api/pastes/digest', params)['data']
+    orphans, unregistered = [], []
+    for ours, theirs in zip(view_buckets, analytic_buckets):
+        if (ours['count'], ours['digest']) == (theirs['count'], theirs['digest']):
+            continue
+        if max(ours['count'], theirs['count']) > RECONCILE_LEAF_SIZE and theirs['end'] - theirs['start'] > 1:
+            more_orphans, more_unregistered = find_mismatches(view, analytics, theirs['start'], theirs['end'])
+            orphans.extend(more_orphans)
+            unregistered.extend(more_unregistered)
+            continue
+        leaf = {'start': theirs['start'], 'end': theirs['end']}
+        analytic_ids = set(call_service(analytics, 'GET', '/api/pastes/ids', leaf)['data']) \
+            if theirs['count'] else set()
+        view_pastes = call_service(view, 'GET', '/api/pastes/reported', leaf)['data'] if ours['count'] else []
+        unregistered.extend(paste for paste in view_pastes if paste['paste_id'] not in analytic_ids)
+        candidates = sorted(analytic_ids.difference(paste['paste_id'] for paste in view_pastes))
+        for chunk_start in range(0, len(candidates), BULK_DELETE_SIZE):
+            chunk = candidates[chunk_start:chunk_start + BULK_DELETE_SIZE]
+            orphans.extend(call_service(view, 'POST', '/api/pastes/missing', json={'paste_ids': chunk})['data'])
+    return orphans, unregistered
+
+def reconcile():
+    view, analytics = SERVICES
+    # Cover the ids of both services; digests of the same range line up bucket by bucket
+    view_top = call_service(view, 'GET', '/api/pastes/digest', {'buckets': 1})
+    analytic_top = call_service(analytics, 'GET', '/api/pastes/digest', {'buckets': 1})
+    if view_top.get('algorithm') != analytic_top.get('algorithm'):
+        raise RuntimeError(f"Digest algorithms differ ({view.name}: {view_top.get('algorithm')}, "
+                           f"{analytics.name}: {analytic_top.get('algorithm')}); deploy the same digests.py")
+    view_max, analytic_max = view_top['max_id'], analytic_top['max_id']
+    orphans, unregistered = find_mismatches(view, analytics, 0, max(view_max, analytic_max) + 1)
+    if orphans:
+        logger.info(f"Deleting {len(orphans)} pastes from {analytics.name} that {view.name} no longer has")
+        for start in range(0, len(orphans), BULK_DELETE_SIZE):
+            delete_from_service(analytics, orphans[start:start + BULK_DELETE_SIZE])
+    if unregistered:
+        logger.info(f"Registering {len(unregistered)} pastes viewed on {view.name} that {analytics.name} lacks")
+        for start in range(0, len(unregistered), BULK_DELETE_SIZE):
+            call_service(analytics, 'POST', '/api/pastes/register',
+                         json={'pastes': unregistered[start:start + BULK_DELETE_SIZE]})
+    # used_short_urls is paste-service's and is never trimmed here: only reported
+    report = call_service(view, 'GET', '/api/reconcile/redis')['data']
+    logger.info(f"Redis: {report['reserved_short_urls']} reserved short URLs for {report['pastes']} pastes "
+                f"on {view.name} ({report['reserved_without_paste']} without one)")
+
+def run_reconciler():
+    """
+    Reconcile every RECONCILE_INTERVAL seconds on whichever replica first
+    claims the interval, so that replicas do not repeat the work. A failed
+    run is retried in the next interval.
+    """
     while True:
         try:
-            logger.info("Starting cleanup of expired pastes")
-            # Lấy danh sách paste hết hạn từ các service
- 
-            view_service_pastes = []
-            analytic_service_pastes = []
-
+            if redis_client.set(RECONCILE_CLAIM_KEY, leases.WORKER_ID, nx=True, ex=RECONCILE_INTERVAL):
+                started = time.monotonic()
+                reconcile()
+                logger.info(f"Reconciliation completed in {time.monotonic() - started:.1f}s")
+        except Exception as e:
+            logger.error(f"Reconciliation failed: {str(e)}")
+        time.sleep(min(RECONCILE_INTERVAL, CLEANUP_LEASE_TTL))
 
+# Cleanup logic
+def cleanup_expired_pastes():
+    """
+    Sweep each partition this worker holds the lease on every CLEANUP_INTERVAL
+    seconds. Leases are checked every CLEANUP_LEASE_TTL seconds, so a
+    partition taken over from another worker is swept right away.
+    """
+    last_swept = {}
+    while True:
+        due = [partition for partition in partition_leases.owned_partitions()
+               if time.monotonic() - last_swept.get(partition, float('-inf')) >= CLEANUP_INTERVAL]
+        if due:
             try:
-                view_service_pastes = get_expired_pastes_from_service(VIEW_SERVICE_URL, "View Service")
-            except Exception as e:
-                logger.warning(f"Skipping View Service due to error: {str(e)}")
+                logger.info(f"Starting cleanup of expired pastes in partitions {due}")
+                started = time.monotonic()
+                # Duyệt paste hết hạn của từng partition và từng service, bắt đầu từ watermark
+                for partition in due:
+                    last_swept[partition] = time.monotonic()
+                    for service in SERVICES:
+                        try:
+                            found, cleaned = cleanup_from_service(service, partition)
+                            logger.info(f"{service.name}, partition {partition}: "
+                                        f"{cleaned}/{found} expired pastes deleted from all services")
+                        except Exception as e:
+                            logger.warning(f"Skipping {service.name} for partition {partition} due to error: {str(e)}")
+                logger.info(f"Cleanup of partitions {due} completed in {time.monotonic() - started:.1f}s")
 
-            try:
-                analytic_service_pastes = get_expired_pastes_from_service(ANALYTIC_SERVICE_URL, "Analytic Service")
             except Exception as e:
-                logger.warning(f"Skipping Analytic Service due to error: {str(e)}")
-
-            # Kết hợp và loại bỏ trùng lặp dựa trên paste_id
-            all_pastes = {}
-            for paste in paste_service_pastes + view_service_pastes + analytic_service_pastes:
-                paste_id = paste.get('paste_id')
-                if paste_id and paste_id not in all_pastes:
-                    all_pastes[paste_id] = paste
-
-            expired_pastes = list(all_pastes.values())
-            if expired_pastes:
-                logger.info(f"Found {len(expired_pastes)} unique expired pastes to delete")
-                for paste in expired_pastes:
-                    paste_id = paste.get('paste_id')
-                    success = True
-
-                    # Thử xóa từ tất cả các service
-                    try:
-                        delete_from_paste_service(paste_id)
-                    except Exception as e:
-                        logger.error(f"Failed to delete paste {paste_id} from Paste Service: {str(e)}")
-                        success = False
-
-                    try:
-                        delete_from_view_service(paste_id)
-                    except Exception as e:
-                        logger.error(f"Failed to delete paste {paste_id} from View Service: {str(e)}")
-                        success = False
-
-                    try:
-                        delete_from_analytic_service(paste_id)
-                    except Exception as e:
-                        logger.error(f"Failed to delete paste {paste_id} from Analytic Service: {str(e)}")
-                        success = False
-
-                    if success:
-                        logger.info(f"Successfully cleaned up paste {paste_id} from all services")
-                    else:
-                        logger.warning(f"Partial failure in cleaning up paste {paste_id}")
-
-                logger.info("Cleanup completed successfully")
-            else:
-                logger.info("No expired pastes found")
-
-        except Exception as e:
-            logger.error(f"Cleanup failed: {str(e)}")
+                logger.error(f"Cleanup failed: {str(e)}")
 
-        logger.info(f"Next cleanup in {CLEANUP_INTERVAL} seconds")
-        time.sleep(CLEANUP_INTERVAL)
+        time.sleep(min(CLEANUP_INTERVAL, CLEANUP_LEASE_TTL))
 
 if __name__ == '__main__':
-    logger.info("Cleanup service started")
+    logger.info(f"Cleanup service started as worker {leases.WORKER_ID}")
+    partition_leases.start()
+    if EXPIRY_SCHEDULER_ENABLED:
+        threading.Thread(target=run_expiry_scheduler, name='expiry-scheduler', daemon=True).start()
+    if RECONCILE_ENABLED:
+        threading.Thread(target=run_reconciler, name='reconciler', daemon=True).start()
     cleanup_expired_pastes()
@@ -0,0 +1,132 @@
+"""
+Lease-based ownership of cleanup partitions.
+
+Cleanup work is split into `partitions` partitions (paste_id mod N). A worker
+may only sweep a partition while it holds the partition's lease: the Redis
+key cleanup:lease:<p>, set with NX and a TTL and holding the worker's id.
+The worker renews its leases every ttl/3 seconds. A worker that dies stops
+renewing, and its leases expire and are taken over within one TTL.
+
+Every worker heartbeats into the cleanup:workers sorted set. It aims for
+ceil(partitions / live workers) leases: it takes free leases up to that
+share and releases any beyond it, so the partitions spread out as replicas
+come and go. Renewal and release are compare-and-set Lua scripts, so a
+worker never extends or drops a lease that has passed to another worker.
+"""
+import logging
+import math
+import os
+import socket
+import threading
+import time
+import uuid
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+LEASE_KEY = 'cleanup:lease:{}'
+WORKERS_KEY = 'cleanup:workers'
+
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+# Extend the lease only if this worker still holds it
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class PartitionLeases:
+    def __init__(self, client, partitions, ttl):
+        self.client = client
+        self.partitions = partitions
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # partition -> monotonic deadline by which the lease must have been renewed
+        self.owned = {}
+        self.renew = client.register_script(RENEW_SCRIPT)
+        self.release = client.register_script(RELEASE_SCRIPT)
+        self.thread = None
+
+    def owns(self, partition):
+        """Whether this worker holds the lease, with a safety margin before it could expire."""
+        with self.lock:
+            return self.owned.get(partition, 0) > time.monotonic()
+
+    def owned_partitions(self):
+        now = time.monotonic()
+        with self.lock:
+            return sorted(p for p, deadline in self.owned.items() if deadline > now)
+
+    def _live_workers(self, now):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.zadd(WORKERS_KEY, {WORKER_ID: now})
+        pipe.zremrangebyscore(WORKERS_KEY, '-inf', now - self.ttl)
+        pipe.zcard(WORKERS_KEY)
+        return max(1, pipe.execute()[-1])
+
+    def refresh(self):
+        """Heartbeat, renew the held leases, and take or release leases toward the fair share."""
+        started = time.monotonic()
+        # Renewed leases count as held until 2/3 of the TTL, leaving the rest as margin
+        deadline = started + self.ttl * 2 / 3
+        ttl_ms = int(self.ttl * 1000)
+        share = math.ceil(self.partitions / self._live_workers(time.time()))
+
+        held = []
+        for partition in self.owned_partitions():
+            if self.renew(keys=[LEASE_KEY.format(partition)], args=[WORKER_ID, ttl_ms]):
+                held.append(partition)
+            else:
+                logger.warning(f"Lost the lease on cleanup partition {partition}")
+
+        for partition in held[share:]:
+            self.release(keys=[LEASE_KEY.format(partition)], args=[WORKER_ID])
+            logger.info(f"Released cleanup partition {partition} (share is {share})")
+        held = held[:share]
+
+        # Start at a worker-specific offset so that workers starting together spread out
+        offset = hash(WORKER_ID) % self.partitions
+        for i in range(self.partitions):
+            if len(held) >= share:
+                break
+            partition = (offset + i) % self.partitions
+            if partition not in held and self.client.set(LEASE_KEY.format(partition), WORKER_ID, nx=True, px=ttl_ms):
+                held.append(partition)
+                logger.info(f"Acquired cleanup partition {partition}")
+
+        with self.lock:
+            self.owned = {partition: deadline for partition in held}
+
+    def release_all(self):
+        for partition in self.owned_partitions():
+            try:
+                self.release(keys=[LEASE_KEY.format(partition)], args=[WORKER_ID])
+            except redis.RedisError:
+                pass
+        with self.lock:
+            self.owned = {}
+
+    def start(self):
+        def run():
+            while True:
+                try:
+                    self.refresh()
+                except Exception as e:
+                    # Leases not renewed lapse on their own; stop sweeping them meanwhile
+                    logger.error(f"Failed to refresh cleanup leases: {str(e)}")
+                time.sleep(self.ttl / 3)
+
+        self.thread = threading.Thread(target=run, name='cleanup-leases', daemon=True)
+        self.thread.start()
+        return self.thread
@@ -0,0 +1,98 @@
+import time
+
+import pytest
+
+import leases
+
+PARTITIONS = 8
+TTL = 30
+
+
+class Worker:
+    """A PartitionLeases under its own WORKER_ID, as if in another process."""
+
+    def __init__(self, client, name, monkeypatch, ttl=TTL):
+        self.name = name
+        self.monkeypatch = monkeypatch
+        self.leases = leases.PartitionLeases(client, PARTITIONS, ttl)
+
+    def run(self, method):
+        self.monkeypatch.setattr(leases, 'WORKER_ID', self.name)
+        return getattr(self.leases, method)()
+
+    def refresh(self):
+        self.run('refresh')
+        return self.leases.owned_partitions()
+
+
+@pytest.fixture
+def workers(redis_client, monkeypatch):
+    return lambda name, **kwargs: Worker(redis_client, name, monkeypatch, **kwargs)
+
+
+def holder(client, partition):
+    return client.get(leases.LEASE_KEY.format(partition))
+
+
+def test_single_worker_takes_every_partition(redis_client, workers):
+    a = workers('a')
+
+    assert a.refresh() == list(range(PARTITIONS))
+    assert all(a.leases.owns(p) for p in range(PARTITIONS))
+    assert all(holder(redis_client, p) == 'a' for p in range(PARTITIONS))
+    assert redis_client.pttl(leases.LEASE_KEY.format(0)) > (TTL - 1) * 1000
+
+
+def test_partitions_spread_to_a_fair_share(redis_client, workers):
+    a, b = workers('a'), workers('b')
+    a.refresh()
+
+    # b joins: every lease is taken, so it waits for a to give up its excess
+    assert b.refresh() == []
+    assert len(a.refresh()) == PARTITIONS // 2
+    owned_b = b.refresh()
+
+    owned_a = a.leases.owned_partitions()
+    assert len(owned_b) == PARTITIONS // 2
+    assert sorted(owned_a + owned_b) == list(range(PARTITIONS))
+    assert all(holder(redis_client, p) == 'b' for p in owned_b)
+
+
+def test_dead_workers_stop_counting(redis_client, workers):
+    redis_client.zadd(leases.WORKERS_KEY, {'gone': time.time() - 2 * TTL})
+
+    assert len(workers('a').refresh()) == PARTITIONS
+    assert redis_client.zrange(leases.WORKERS_KEY, 0, -1) == ['a']
+
+
+def test_renewal_does_not_extend_a_lease_taken_over(redis_client, workers):
+    a = workers('a')
+    a.refresh()
+    # a's lease on 3 lapsed and c took it
+    redis_client.set(leases.LEASE_KEY.format(3), 'c', px=TTL * 1000)
+    redis_client.zadd(leases.WORKERS_KEY, {'c': time.time()})
+
+    assert 3 not in a.refresh()
+    assert not a.leases.owns(3)
+    assert holder(redis_client, 3) == 'c'
+
+
+def test_release_all_only_drops_own_leases(redis_client, workers):
+    a = workers('a')
+    a.refresh()
+    redis_client.set(leases.LEASE_KEY.format(5), 'c')
+
+    a.run('release_all')
+
+    assert a.leases.owned_partitions() == []
+    assert [p for p in range(PARTITIONS) if holder(redis_client, p)] == [5]
+    assert holder(redis_client, 5) == 'c'
+
+
+def test_lease_is_not_trusted_past_its_margin(workers):
+    a = workers('a', ttl=0.06)
+    a.refresh()
+    assert a.leases.owns(0)
+
+    time.sleep(0.05)
+    assert not a.leases.owns(0)
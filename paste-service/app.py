@@ -3,7 +3,7 @@ import uuid
 import logging
 import redis
 import json
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 from flask import Flask, jsonify, request, render_template
 import requests
@@ -30,6 +30,8 @@ REDIS_PORT = int(os.getenv('REDIS_PORT', '6379'))
 RETRY_ATTEMPTS = int(os.getenv('RETRY_ATTEMPTS', '3'))
 RETRY_DELAY = float(os.getenv('RETRY_DELAY', '1'))
 BASE62_CHARS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+# Sorted set of paste_id -> expires_at (UNIX seconds), popped by the cleanup service
+EXPIRY_SCHEDULE_KEY = 'paste_expiry'
 
 # Initialize Redis client with connection pool
 redis_client = redis.Redis(
@@ -168,6 +170,14 @@ def create_paste():
         except redis.RedisError as e:
             logger.error(f"Failed to cache paste {paste_id}: {str(e)}")
 
+        # Lên lịch xóa: cleanup xóa paste ngay khi hết hạn
+        if expires_at:
+            try:
+                redis_client.zadd(EXPIRY_SCHEDULE_KEY, {paste_id: expires_at.replace(tzinfo=timezone.utc).timestamp()})
+            except redis.RedisError as e:
+                # The cleanup sweep still finds the paste, only later
+                logger.error(f"Failed to schedule expiry of paste {paste_id}: {str(e)}")
+
         # Queue paste to View Service asynchronously
         try:
             send_paste_to_view_service_async.delay(paste_data)
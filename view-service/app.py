@@ -11,6 +11,8 @@ from datetime import datetime
 from sqlalchemy import func
 from sqlalchemy.exc import OperationalError
 
+import digests
+
 app = Flask(__name__)
 
 # Database configuration
@@ -48,6 +50,14 @@ ANALYTIC_SERVICE_URL = os.getenv('ANALYTIC_SERVICE_URL', 'http://analytics-servi
 
 redis_client = redis.Redis(host='redis', port=6379, decode_responses=True, db=0)
 
+# Expired paste pages: default and maximum ?limit=
+EXPIRED_PAGE_SIZE = int(os.getenv('EXPIRED_PAGE_SIZE', '1000'))
+EXPIRED_PAGE_MAX = int(os.getenv('EXPIRED_PAGE_MAX', '5000'))
+
+# Bulk deletes: ids accepted per request, and ids per DELETE ... IN (...) statement
+BULK_DELETE_MAX = int(os.getenv('BULK_DELETE_MAX', '5000'))
+BULK_DELETE_CHUNK = int(os.getenv('BULK_DELETE_CHUNK', '500'))
+
 def retry_on_deadlock(max_retries=3, delay=0.1):
     def decorator(func):
         @wraps(func)
@@ -215,6 +225,8 @@ def send_view_to_analytic(paste):
         "short_url": paste.short_url,
         "view_count": paste.view_count
     }
+    if paste.expires_at:
+        paste_data["metadata"] = {"expires_at": paste.expires_at.isoformat()}
     send_view_to_analytic_async.delay(paste_data)
 
 # API Endpoints
@@ -308,24 +320,63 @@ def receive_paste():
         app.logger.error(f"View Service Error: {str(e)}", exc_info=True)
         return jsonify({"error": str(e)}), 400
 
+def parse_expired_cursor(value):
+    """Parse an `<expires_at ISO>,<paste_id>` cursor; raise ValueError otherwise."""
+    try:
+        expires_at, paste_id = value.rsplit(',', 1)
+        return datetime.fromisoformat(expires_at), int(paste_id)
+    except ValueError:
+        raise ValueError(f"Invalid cursor '{value}'; use <expires_at ISO>,<paste_id>")
+
+def parse_partition(args):
+    """`?partition=p&partitions=n` (pastes with paste_id % n == p) as (p, n), or None; raise ValueError if invalid."""
+    if 'partition' not in args and 'partitions' not in args:
+        return None
+    partition = args.get('partition', type=int)
+    partitions = args.get('partitions', type=int)
+    if partition is None or partitions is None or not 0 <= partition < partitions:
+        raise ValueError("partition and partitions must be integers with 0 <= partition < partitions")
+    return partition, partitions
+
 @app.route("/api/pastes/expired", methods=["GET"])
 @retry_on_deadlock(max_retries=3, delay=0.1)
 def get_expired_pastes():
+    limit = min(max(request.args.get('limit', EXPIRED_PAGE_SIZE, type=int), 1), EXPIRED_PAGE_MAX)
     try:
-        expired_pastes = Paste.query.filter(
+        after = parse_expired_cursor(request.args['after']) if request.args.get('after') else None
+        partition = parse_partition(request.args)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    try:
+        # Keyset page in (expires_at, paste_id) order: a range scan on the expires_at
+        # index, whose entries carry the primary key
+        query = Paste.query.with_entities(Paste.paste_id, Paste.short_url, Paste.expires_at).filter(
             Paste.expires_at <= datetime.utcnow(),
             Paste.expires_at != None
-        ).all()
+        )
+        if partition:
+            query = query.filter(Paste.paste_id % partition[1] == partition[0])
+        if after:
+            query = query.filter(
+                (Paste.expires_at > after[0]) | ((Paste.expires_at == after[0]) & (Paste.paste_id > after[1]))
+            )
+        expired_pastes = query.order_by(Paste.expires_at, Paste.paste_id).limit(limit).all()
         pastes_data = [
             {
                 "paste_id": paste.paste_id,
                 "short_url": paste.short_url,
-                "expires_at": paste.expires_at.isoformat() if paste.expires_at else None
+                "expires_at": paste.expires_at.isoformat()
             }
             for paste in expired_pastes
         ]
+        last = expired_pastes[-1] if len(expired_pastes) == limit else None
         app.logger.info(f"Retrieved {len(pastes_data)} expired pastes from View Service")
-        return jsonify({"status": "success", "data": pastes_data}), 200
+        return jsonify({
+            "status": "success",
+            "data": pastes_data,
+            "next": f"{last.expires_at.isoformat()},{last.paste_id}" if last else None
+        }), 200
     except OperationalError as e:
         app.logger.error(f"Database error retrieving expired pastes: {str(e)}")
         return jsonify({"error": "Database unavailable"}), 503
@@ -362,5 +413,167 @@ def delete_paste(paste_id):
         app.logger.error(f"Failed to delete paste {paste_id}: {str(e)}")
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
 
+def parse_paste_ids(data):
+    """The `paste_ids` of a bulk request, deduplicated; raise ValueError if invalid."""
+    paste_ids = (data or {}).get('paste_ids')
+    if not isinstance(paste_ids, list) or not paste_ids:
+        raise ValueError("paste_ids must be a non-empty list")
+    if len(paste_ids) > BULK_DELETE_MAX:
+        raise ValueError(f"At most {BULK_DELETE_MAX} paste_ids per request")
+    if not all(isinstance(paste_id, int) and not isinstance(paste_id, bool) for paste_id in paste_ids):
+        raise ValueError("paste_ids must be integers")
+    return list(dict.fromkeys(paste_ids))
+
+@app.route("/api/pastes/delete", methods=["POST"])
+@retry_on_deadlock(max_retries=3, delay=0.1)
+def bulk_delete_pastes():
+    try:
+        paste_ids = parse_paste_ids(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    try:
+        deleted = {}
+        for start in range(0, len(paste_ids), BULK_DELETE_CHUNK):
+            chunk = paste_ids[start:start + BULK_DELETE_CHUNK]
+            # Mỗi chunk là một transaction ngắn
+            rows = db.session.query(Paste.paste_id, Paste.short_url).filter(Paste.paste_id.in_(chunk)).all()
+            found = [paste_id for paste_id, _ in rows]
+            if found:
+                View.query.filter(View.paste_id.in_(found)).delete(synchronize_session=False)
+                Paste.query.filter(Paste.paste_id.in_(found)).delete(synchronize_session=False)
+            db.session.commit()
+            deleted.update(rows)
+
+        # Xóa cache liên quan trong Redis, một round trip cho cả request.
+        # used_short_urls belongs to paste-service and keeps the short URLs reserved.
+        if deleted:
+            short_urls = list(deleted.values())
+            try:
+                redis_client.unlink(*[f"{prefix}:{short_url}" for short_url in short_urls
+                                      for prefix in ('paste', 'view_count')])
+            except redis.RedisError as e:
+                # The rows are gone already; cached copies expire on their own
+                app.logger.warning(f"Failed to purge cache of {len(short_urls)} deleted pastes: {str(e)}")
+
+        app.logger.info(f"Bulk deleted {len(deleted)} of {len(paste_ids)} pastes and related cache from View Service")
+        return jsonify({
+            "status": "success",
+            "data": {
+                "deleted": list(deleted),
+                "not_found": [paste_id for paste_id in paste_ids if paste_id not in deleted]
+            }
+        }), 200
+    except OperationalError as e:
+        db.session.rollback()
+        app.logger.error(f"Database error bulk deleting pastes: {str(e)}")
+        return jsonify({"error": "Database unavailable"}), 503
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Failed to bulk delete pastes: {str(e)}")
+        return jsonify({"error": f"Internal server error: {str(e)}"}), 500
+
+
+@app.route("/api/pastes/digest", methods=["GET"])
+def get_paste_digest():
+    """
+    Count and XOR of CRC32(paste_id) per id range (see digests.py) of the
+    pastes reported to analytics, i.e. viewed: sync_view_counts sets their
+    view_count > 0 within a run of its schedule. Analytics holds the same set.
+    """
+    try:
+        start, end, buckets = digests.parse_range(request.args)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    try:
+        conn = db.session.connection()
+        max_id = db.session.query(func.max(Paste.paste_id)).scalar() or 0
+        end = max(start, max_id + 1) if end is None else end
+        data = digests.range_digests(conn, 'paste', 'paste_id', start, end, buckets, condition='view_count > 0')
+        return jsonify({"status": "success", "data": data, "max_id": max_id,
+                        "algorithm": digests.ALGORITHM}), 200
+    except OperationalError as e:
+        app.logger.error(f"Database error computing paste digests: {str(e)}")
+        return jsonify({"error": "Database unavailable"}), 503
+
+@app.route("/api/pastes/reported", methods=["GET"])
+def get_reported_pastes():
+    """
+    The pastes of [start, end) in the digests (view_count > 0), with the
+    short_url and expires_at analytics keeps, for ranges whose digests differ.
+    """
+    try:
+        start, end, _ = digests.parse_range(request.args)
+        if end is None:
+            raise ValueError("end is required")
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    try:
+        rows = db.session.query(Paste.paste_id, Paste.short_url, Paste.expires_at).filter(
+            Paste.paste_id >= start,
+            Paste.paste_id < end,
+            Paste.view_count > 0
+        ).order_by(Paste.paste_id).limit(digests.IDS_MAX + 1).all()
+        if len(rows) > digests.IDS_MAX:
+            return jsonify({"status": "error", "message": f"More than {digests.IDS_MAX} pastes in range; "
+                                                          f"ask for digests of smaller ranges"}), 400
+        return jsonify({"status": "success", "data": [{
+            "paste_id": paste_id,
+            "short_url": short_url,
+            "expires_at": expires_at.isoformat() if expires_at else None
+        } for paste_id, short_url, expires_at in rows]}), 200
+    except OperationalError as e:
+        app.logger.error(f"Database error listing reported pastes: {str(e)}")
+        return jsonify({"error": "Database unavailable"}), 503
+
+@app.route("/api/pastes/missing", methods=["POST"])
+def get_missing_pastes():
+    """Which of the `paste_ids` do not exist, for the ids of analytics ranges whose digests differ."""
+    try:
+        paste_ids = parse_paste_ids(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    try:
+        existing = set()
+        for start in range(0, len(paste_ids), BULK_DELETE_CHUNK):
+            existing.update(paste_id for (paste_id,) in db.session.query(Paste.paste_id).filter(
+                Paste.paste_id.in_(paste_ids[start:start + BULK_DELETE_CHUNK])
+            ))
+        return jsonify({"status": "success",
+                        "data": [paste_id for paste_id in paste_ids if paste_id not in existing]}), 200
+    except OperationalError as e:
+        app.logger.error(f"Database error checking paste ids: {str(e)}")
+        return jsonify({"error": "Database unavailable"}), 503
+
+@app.route("/api/reconcile/redis", methods=["GET"])
+def reconcile_redis():
+    """
+    Report on the Redis entries of pastes, for the reconciler. Nothing is
+    removed and nothing is scanned:
+    - view_count:* keys need no sweep, since sync_view_counts deletes every
+      counter it reads, whether or not its paste still exists.
+    - used_short_urls belongs to paste-service, and a member keeps a short
+      URL from being handed out again even after its paste is gone. Its
+      size is reported next to the number of pastes here; the difference
+      counts short URLs of deleted pastes and of pastes still in flight.
+    """
+    try:
+        reserved = redis_client.scard('used_short_urls')
+        pastes = db.session.query(func.count(Paste.paste_id)).scalar()
+        return jsonify({
+            "status": "success",
+            "data": {
+                "reserved_short_urls": reserved,
+                "pastes": pastes,
+                "reserved_without_paste": max(0, reserved - pastes)
+            }
+        }), 200
+    except OperationalError as e:
+        app.logger.error(f"Database error reporting on Redis: {str(e)}")
+        return jsonify({"error": "Database unavailable"}), 503
+    except redis.RedisError as e:
+        app.logger.error(f"Redis error reporting on Redis: {str(e)}")
+        return jsonify({"error": "Redis unavailable"}), 503
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5002, debug=False)
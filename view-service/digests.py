@@ -0,0 +1,84 @@
+"""
+Range digests of paste ids, for the anti-entropy check run by cleanup-service.
+
+A digest summarizes the ids of a table column in [start, end) as a count and
+the XOR of CRC32(id) (as a decimal string, like MySQL's CRC32()). XOR does
+not depend on order, so MySQL computes it in one grouped index range scan:
+BIT_XOR(CRC32(id)) per bucket of (id - start) DIV width. Two services hold
+the same ids in a bucket when their digests match, up to CRC32 collisions.
+The reconciler in cleanup-service only looks at the ids of buckets that
+differ.
+
+This module is kept identical in analytics-service and view-service, which
+must produce the same digest for the same ids. Digest responses carry
+ALGORITHM, and the reconciler refuses to compare digests whose ALGORITHM
+differs: change it whenever the digest definition changes.
+"""
+import zlib
+
+from sqlalchemy import text
+
+ALGORITHM = 'count+xor-crc32-decimal/1'
+DIGEST_MAX_BUCKETS = 256
+IDS_MAX = 10000
+
+
+def bucket_width(start, end, buckets):
+    return max(1, -(-(end - start) // buckets))
+
+
+def crc32(value):
+    return zlib.crc32(str(value).encode('ascii'))
+
+
+def range_digests(conn, table, column, start, end, buckets, condition=None):
+    """
+    [{start, end, count, digest}] for `buckets` equal ranges of [start, end),
+    empty ones included, over the rows matching the SQL `condition` if given.
+    """
+    width = bucket_width(start, end, buckets)
+    params = {'start': start, 'end': end, 'width': width}
+    where = f"{column} >= :start AND {column} < :end" + (f" AND {condition}" if condition else "")
+    totals = {}
+    if conn.dialect.name == 'mysql':
+        for bucket, count, digest in conn.execute(text(
+            f"SELECT ({column} - :start) DIV :width AS bucket, COUNT(*), BIT_XOR(CRC32({column})) "
+            f"FROM {table} WHERE {where} GROUP BY bucket"
+        ), params):
+            totals[int(bucket)] = (int(count), int(digest))
+    else:
+        for (value,) in conn.execute(text(f"SELECT {column} FROM {table} WHERE {where}"), params):
+            count, digest = totals.get((value - start) // width, (0, 0))
+            totals[(value - start) // width] = (count + 1, digest ^ crc32(value))
+
+    result = []
+    for bucket in range(buckets):
+        bucket_start = start + bucket * width
+        if bucket_start >= end:
+            break
+        count, digest = totals.get(bucket, (0, 0))
+        result.append({'start': bucket_start, 'end': min(end, bucket_start + width),
+                       'count': count, 'digest': digest})
+    return result
+
+
+def ids_in_range(conn, table, column, start, end):
+    """The ids in [start, end), at most IDS_MAX; raise ValueError beyond that."""
+    ids = [row[0] for row in conn.execute(text(
+        f"SELECT {column} FROM {table} WHERE {column} >= :start AND {column} < :end ORDER BY {column} LIMIT :limit"
+    ), {'start': start, 'end': end, 'limit': IDS_MAX + 1})]
+    if len(ids) > IDS_MAX:
+        raise ValueError(f"More than {IDS_MAX} ids in range; ask for digests of smaller ranges")
+    return ids
+
+
+def parse_range(args, max_buckets=DIGEST_MAX_BUCKETS):
+    """`?start=&end=&buckets=` as integers (end defaults to None); raise ValueError if invalid."""
+    start = args.get('start', 0, type=int)
+    end = args.get('end', type=int)
+    buckets = args.get('buckets', 16, type=int)
+    if start < 0 or (end is not None and end <= start):
+        raise ValueError("start must be >= 0 and below end")
+    if not 1 <= buckets <= max_buckets:
+        raise ValueError(f"buckets must be between 1 and {max_buckets}")
+    return start, end, buckets